@@ -0,0 +1,111 @@
+# ##### BEGIN MIT LICENSE BLOCK #####
+#
+# Copyright (c) 2015 - 2017 Pixar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#
+# ##### END MIT LICENSE BLOCK #####
+
+
+
+# A cache of parsed .args files, kept with the user's blender data so every
+# launch doesn't have to read and parse all the args files again, which is
+# slow when RMANTREE is on the network.  Each file is keyed by its path,
+# size and mtime, and only parsed again when one of those changes.
+
+import os
+import time
+import pickle
+import traceback
+import xml.etree.ElementTree as ET
+
+ARGS_CACHE_VERSION = 1
+ARGS_CACHE_NAME = 'args_cache.pickle'
+
+
+def args_cache_path(cache_dir):
+    return os.path.join(cache_dir, ARGS_CACHE_NAME)
+
+
+def load_args_cache(cache_dir):
+    try:
+        with open(args_cache_path(cache_dir), 'rb') as f:
+            cache = pickle.load(f)
+        if cache.get('version') == ARGS_CACHE_VERSION:
+            return cache['args']
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+            KeyError, ImportError, TypeError, ValueError):
+        pass
+    return None
+
+
+def save_args_cache(cache_dir, args_cache):
+    path = args_cache_path(cache_dir)
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            pickle.dump({'version': ARGS_CACHE_VERSION, 'args': args_cache},
+                        f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except (OSError, pickle.PicklingError):
+        print('RenderMan: could not write the args cache', path)
+
+
+def get_args_stamp(arg_file):
+    stat = os.stat(arg_file)
+    return (stat.st_size, stat.st_mtime)
+
+
+# the root xml element of every args file, by shader name.  files that
+# haven't changed since they were cached aren't read.  with no cache_dir
+# everything is parsed.  a message with the load time and whether the cache
+# was cold or warm is printed
+def parse_args_files(args_files, cache_dir=None):
+    start = time.time()
+    cache = load_args_cache(cache_dir) if cache_dir else None
+    cold = cache is None
+    if cache is None:
+        cache = {}
+
+    parsed = {}
+    new_cache = {}
+    num_parsed = 0
+    for name, arg_file in args_files.items():
+        try:
+            stamp = get_args_stamp(arg_file)
+            entry = cache.get(arg_file)
+            if entry is not None and entry[0] == stamp:
+                root = entry[1]
+            else:
+                root = ET.parse(arg_file).getroot()
+                num_parsed += 1
+            new_cache[arg_file] = (stamp, root)
+            parsed[name] = root
+        except Exception:
+            print("Error parsing " + name)
+            traceback.print_exc()
+
+    if cache_dir and (num_parsed or len(new_cache) != len(cache)):
+        save_args_cache(cache_dir, new_cache)
+
+    print('RenderMan: loaded %d args files in %.2fs, %d parsed (%s cache)' %
+          (len(parsed), time.time() - start, num_parsed,
+           'cold' if cold else 'warm'))
+    return parsed
@@ -34,6 +34,7 @@ from mathutils import Matrix, Vector, Quaternion
 import re
 import traceback
 import glob
+import collections
 
 from . import bl_info
 
@@ -59,9 +60,13 @@ from bpy.app.handlers import persistent
 from .export import write_rib, write_preview_rib, get_texture_list,\
     issue_shader_edits, get_texture_list_preview, issue_transform_edits,\
     interactive_initial_rib, update_light_link, delete_light,\
-    reset_light_illum, solo_light, mute_lights, issue_light_vis, update_crop_window
+    reset_light_illum, solo_light, mute_lights, issue_light_vis, update_crop_window,\
+    get_rib_options
 
 from .nodes import get_tex_file_name
+from .texture_manifest import load_texture_manifest, save_texture_manifest
+from .texture_manifest import get_txmake_version, check_texture
+from .texture_manifest import record_texture
 
 addon_version = bl_info['version']
 
@@ -211,6 +216,12 @@ class RPass:
         self.edit_num = 0
         self.update_time = None
         self.last_edit_mat = None
+        # set for multi-frame exports that share static archives
+        self.static_archive_reuse = None
+        # scene evaluations the last cache_motion didn't need to do
+        self.motion_evaluations_saved = 0
+        # group memberships and light links while objects are exported
+        self.linking_index = None
 
     def __del__(self):
 
@@ -587,11 +598,7 @@ class RPass:
             return
 
         self.ri.Begin(self.paths['rib_output'])
-        rib_options = {"string format": "binary"} if rm.rib_format == "binary" else {
-            "string format": "ascii", "string asciistyle": "indented,wide"}
-        if rm.rib_compression == "gzip":
-            rib_options["string compression"] = "gzip"
-        self.ri.Option("rib", rib_options)
+        self.ri.Option("rib", get_rib_options(rm))
         self.material_dict = {}
         self.instance_dict = {}
         self.lights = {}
@@ -767,18 +774,14 @@ class RPass:
             return
         time_start = time.time()
         if convert_textures:
-            self.convert_textures(get_texture_list(self.scene))
+            self.convert_textures(get_texture_list(self.scene), engine)
 
         if engine:
             engine.report({"INFO"}, "Texture generation took %s" %
                           format_seconds_to_hhmmss(time.time() - time_start))
         self.scene.frame_set(self.scene.frame_current)
         time_start = time.time()
-        rib_options = {"string format": "binary"} if rm.rib_format == "binary" else {
-            "string format": "ascii", "string asciistyle": "indented,wide"}
-        if rm.rib_compression == "gzip":
-            rib_options["string compression"] = "gzip"
-        self.ri.Option("rib", rib_options)
+        self.ri.Option("rib", get_rib_options(rm))
         self.ri.Begin(self.paths['rib_output'])
 
         # Check if rendering select objects only.
@@ -809,52 +812,107 @@ class RPass:
         self.rib_done = write_preview_rib(self, self.scene, self.ri)
         self.ri.End()
 
-    def convert_textures(self, temp_texture_list):
+    # expand UDIM tiles into one job each and drop duplicate
+    # (in_file, options) pairs and textures that are up to date
+    def get_texture_jobs(self, temp_texture_list, manifest, txmake_version):
+        jobs = []
+        seen = set()
+        out_files = set()
+        for in_file, out_file, options in temp_texture_list:
+            in_file = get_real_path(in_file)
+            if '_MAPID_' in in_file:
+                tiles = [(udim_file, get_tex_file_name(udim_file)) for udim_file
+                         in sorted(glob.glob(in_file.replace('_MAPID_', '*')))]
+            else:
+                tiles = [(in_file, out_file)]
+
+            for in_file, out_file in tiles:
+                out_file_path = os.path.join(
+                    self.paths['texture_output'], out_file)
+                key = (in_file, tuple(options))
+                if key in seen or out_file_path in out_files:
+                    continue
+                seen.add(key)
+                out_files.add(out_file_path)
+
+                up_to_date, entry = check_texture(manifest, in_file,
+                                                  out_file_path, options,
+                                                  txmake_version)
+                if up_to_date and self.rm.always_generate_textures is False:
+                    debug("info", "TEXTURE %s EXISTS (or is not dirty)!" %
+                          out_file)
+                else:
+                    jobs.append((in_file, out_file_path, options, entry))
+        return jobs
+
+    def convert_textures(self, temp_texture_list, engine=None):
         if not os.path.exists(self.paths['texture_output']):
             os.mkdir(self.paths['texture_output'])
 
-        files_converted = []
-        texture_list = []
-
         if not temp_texture_list:
             return
 
-        # for UDIM textures
-        for in_file, out_file, options in temp_texture_list:
-            if '_MAPID_' in in_file:
-                in_file = get_real_path(in_file)
-                for udim_file in glob.glob(in_file.replace('_MAPID_', '*')):
-                    texture_list.append(
-                        (udim_file, get_tex_file_name(udim_file), options))
-            else:
-                texture_list.append((in_file, out_file, options))
+        txmake = os.path.join(self.paths['rmantree'], 'bin',
+                              self.paths['path_texture_optimiser'])
+        texture_dir = self.paths['texture_output']
+        manifest = load_texture_manifest(texture_dir)
+        old_manifest = dict(manifest)
+        jobs = collections.deque(self.get_texture_jobs(
+            temp_texture_list, manifest, get_txmake_version(txmake)))
+        num_jobs = len(jobs)
+        num_workers = self.rm.texture_conversion_processes
+        if num_workers <= 0:
+            num_workers = max(1, (os.cpu_count() or 1) + num_workers)
+
+        Blendcdir = bpy.path.abspath("//")
+        if not Blendcdir:
+            Blendcdir = None
+        environ = os.environ.copy()
+        environ['RMANTREE'] = self.paths['rmantree']
 
-        for in_file, out_file, options in texture_list:
-            in_file = get_real_path(in_file)
-            out_file_path = os.path.join(
-                self.paths['texture_output'], out_file)
-
-            if os.path.isfile(out_file_path) and os.path.exists(in_file) and\
-                    self.rm.always_generate_textures is False and \
-                    os.path.getmtime(in_file) <= \
-                    os.path.getmtime(out_file_path):
-                debug("info", "TEXTURE %s EXISTS (or is not dirty)!" %
-                      out_file)
-            else:
-                cmd = [os.path.join(self.paths['rmantree'], 'bin',
-                                    self.paths['path_texture_optimiser'])] + \
-                    options + [in_file, out_file_path]
+        files_converted = []
+        running = []
+        while jobs or running:
+            if engine and engine.test_break():
+                # don't leave half written textures behind
+                for process, out_file_path, entry in running:
+                    process.kill()
+                    process.wait()
+                    if os.path.exists(out_file_path):
+                        os.remove(out_file_path)
+                debug("info", "TXMAKE CANCELLED!")
+                break
+
+            while jobs and len(running) < num_workers:
+                in_file, out_file_path, options, entry = jobs.popleft()
+                cmd = [txmake] + options + [in_file, out_file_path]
                 debug("info", "TXMAKE STARTED!", cmd)
-
-                Blendcdir = bpy.path.abspath("//")
-                if not Blendcdir:
-                    Blendcdir = None
-
-                environ = os.environ.copy()
-                environ['RMANTREE'] = self.paths['rmantree']
                 process = subprocess.Popen(cmd, cwd=Blendcdir,
-                                           stdout=subprocess.PIPE, env=environ)
-                process.communicate()
+                                           stdout=subprocess.DEVNULL,
+                                           env=environ)
+                running.append((process, out_file_path, entry))
+
+            still_running = []
+            for process, out_file_path, entry in running:
+                if process.poll() is None:
+                    still_running.append((process, out_file_path, entry))
+                    continue
+                if process.returncode != 0:
+                    debug("error", "TXMAKE FAILED!", out_file_path)
+                    entry = None
+                record_texture(manifest, out_file_path, entry)
                 files_converted.append(out_file_path)
-
+                if engine:
+                    engine.update_stats("", "RenderMan: Converting textures "
+                                        "%d/%d %s" % (len(files_converted),
+                                                      num_jobs,
+                                                      os.path.basename(out_file_path)))
+            if len(still_running) == len(running):
+                time.sleep(0.05)
+            running = still_running
+
+        if manifest != old_manifest and \
+                not save_texture_manifest(texture_dir, manifest):
+            debug("warning", "Could not write the texture manifest",
+                  texture_dir)
         return files_converted
@@ -29,8 +29,15 @@ import mathutils
 import os
 import sys
 import time
+import json
+import pickle
+import hashlib
+import glob
+import tempfile
 import traceback
+import weakref
 import platform
+import numpy as np
 from mathutils import Matrix, Vector, Quaternion, Euler
 
 from . import bl_info
@@ -41,14 +48,16 @@ from .util import init_env
 from .util import get_sequence_path
 from .util import user_path
 from .util import path_list_convert, get_real_path
-from .util import get_properties, check_if_archive_dirty
+from .util import get_properties
 from .util import locate_openVDB_cache
-from .util import debug, get_addon_prefs
+from .util import debug, get_addon_prefs, guess_rmantree
 
 from .util import find_it_path
 from .nodes import export_shader_nodetree, get_textures, get_textures_for_node, get_tex_file_name
+from .nodes import get_light_textures, get_texture_sources_for_node
 from .nodes import shader_node_rib, get_mat_name
 from .nodes import replace_frame_num
+from .rib_writer import RibRecorder, RibWriterPool, write_archive
 
 addon_version = bl_info['version']
 
@@ -246,6 +255,37 @@ def psys_name(ob, psys):
 def fix_name(name):
     return name.replace('/', '')
 
+# the objects using each datablock, keyed by the datablock pointer, and the
+# children of each object, keyed by the object pointer.  these are rebuilt
+# once per export in cache_motion, so the helpers looking for the owners of
+# some data or the children of an object don't each scan bpy.data.objects
+data_owners = {}
+object_children = {}
+
+
+def index_objects():
+    data_owners.clear()
+    object_children.clear()
+    for ob in bpy.data.objects:
+        if ob.data is not None:
+            data_owners.setdefault(ob.data.as_pointer(), []).append(ob)
+        if ob.parent is not None:
+            object_children.setdefault(ob.parent.as_pointer(), []).append(ob)
+
+
+def get_data_owners(data):
+    if not data_owners:
+        index_objects()
+    return data_owners.get(data.as_pointer(), [])
+
+
+# same as ob.children, in the same order
+def get_object_children(ob):
+    if not data_owners and not object_children:
+        index_objects()
+    return object_children.get(ob.as_pointer(), [])
+
+
 # get a name for the data block.  if it's modified by the obj we need it
 # specified
 
@@ -264,11 +304,12 @@ def data_name(ob, scene):
     if is_smoke(ob) or ob.renderman.primitive == 'RI_VOLUME':
         return "%s-VOLUME" % fix_name(ob.name)
 
-    if ob.data.users > 1 and (ob.is_modified(scene, "RENDER") or
-                              ob.is_deform_modified(scene, "RENDER") or
-                              ob.renderman.primitive != 'AUTO' or
-                              (ob.renderman.motion_segments_override and
-                               is_deforming(ob))):
+    shared = len(get_data_owners(ob.data)) > 1
+    if shared and (ob.is_modified(scene, "RENDER") or
+                   ob.is_deform_modified(scene, "RENDER") or
+                   ob.renderman.primitive != 'AUTO' or
+                   (ob.renderman.motion_segments_override and
+                    is_deforming(ob))):
         return "%s.%s-MESH" % (fix_name(ob.name), fix_name(ob.data.name))
 
     else:
@@ -281,7 +322,36 @@ def get_name(ob):
 
 
 # ------------- Geometry Access -------------
-def get_strands(scene, ob, psys, objectCorrectionMatrix=False):
+# hair is written in ri.Curves calls of about this many vertices, to avoid
+# a maxint on the array length
+HAIR_CHUNK_VERTS = 100000
+
+
+# build one curve set from the strand points read one after the other into
+# raw, where strand i has lengths[i] points.  the first and last point of
+# every strand are doubled
+def get_hair_chunk(raw, lengths, base_width, tip_width):
+    vertsArray = lengths + 2
+    first = np.repeat(np.cumsum(vertsArray) - vertsArray, vertsArray)
+    local = np.arange(len(first)) - first
+    start = np.repeat(np.cumsum(lengths) - lengths, vertsArray)
+    point = start + np.clip(local - 1, 0, np.repeat(lengths - 1, vertsArray))
+    points = raw[point].reshape(-1)
+
+    if tip_width == base_width:
+        return vertsArray, points, base_width
+
+    # for varying width make the width array
+    decr = np.repeat((base_width - tip_width) / lengths, vertsArray)
+    hair_width = base_width - decr * (local - 1)
+    hair_width[local == 0] = base_width
+    hair_width[local == np.repeat(vertsArray - 1, vertsArray)] = tip_width
+    return vertsArray, points, hair_width.astype(np.float32)
+
+
+# yields the curve sets of a hair system one at a time, so only one chunk of
+# it is in memory while it is written
+def iter_strands(scene, ob, psys, objectCorrectionMatrix=False):
     # we need this to get st
     if(objectCorrectionMatrix):
         matrix = ob.matrix_world.inverted_safe()
@@ -294,99 +364,114 @@ def get_strands(scene, ob, psys, objectCorrectionMatrix=False):
 
     tip_width = psys.settings.cycles.tip_width * psys.settings.cycles.radius_scale
     base_width = psys.settings.cycles.root_width * psys.settings.cycles.radius_scale
-    conwidth = (tip_width == base_width)
     steps = 2 ** psys.settings.render_step
-    if conwidth:
+    if tip_width == base_width:
         widthString = "constantwidth"
-        hair_width = base_width
-        debug("info", widthString, hair_width)
+        debug("info", widthString, base_width)
     else:
         widthString = "vertex float width"
-        hair_width = []
-
-    psys.set_resolution(scene=scene, object=ob, resolution='RENDER')
 
     num_parents = len(psys.particles)
     num_children = len(psys.child_particles)
     total_hair_count = num_parents + num_children
     export_st = psys.settings.renderman.export_scalp_st and psys_modifier and len(
         ob.data.uv_layers) > 0
-
-    curve_sets = []
-
-    points = []
-
-    vertsArray = []
-    scalpS = []
-    scalpT = []
+    first_strand = num_parents if psys.settings.child_type != 'NONE' else 0
+
+    # strand points are read into one buffer per chunk.  a chunk is closed
+    # once it has more than HAIR_CHUNK_VERTS vertices, so it holds at most
+    # this many strands and points
+    max_strands = HAIR_CHUNK_VERTS // 3 + 2
+    raw = np.empty((HAIR_CHUNK_VERTS + steps + 1, 3), dtype=np.float32)
+    lengths = np.empty(max_strands, dtype=np.int64)
+    scalpS = np.empty(max_strands, dtype=np.float32)
+    scalpT = np.empty(max_strands, dtype=np.float32)
+    co_hair = psys.co_hair
+    particles = psys.particles
+    num_strands = 0
+    num_points = 0
     nverts = 0
-    for pindex in range(total_hair_count):
-        if psys.settings.child_type != 'NONE' and pindex < num_parents:
-            continue
-
-        strand_points = []
-        # walk through each strand
-        for step in range(0, steps + 1):
-            pt = psys.co_hair(object=ob, particle_no=pindex, step=step)
 
-            if(objectCorrectionMatrix):
-                pt = pt + loc
+    def get_chunk():
+        vertsArray, points, hair_width = get_hair_chunk(
+            raw, lengths[:num_strands], base_width, tip_width)
+        if export_st:
+            return (vertsArray, points, widthString, hair_width,
+                    scalpS[:num_strands].copy(), scalpT[:num_strands].copy())
+        return (vertsArray, points, widthString, hair_width, [], [])
 
-            if not pt.length_squared == 0:
-                strand_points.extend(pt)
-            else:
-                # this strand ends prematurely
-                break
+    psys.set_resolution(scene=scene, object=ob, resolution='RENDER')
+    try:
+        for pindex in range(first_strand, total_hair_count):
+            length = 0
+            # walk through each strand
+            for step in range(0, steps + 1):
+                pt = co_hair(object=ob, particle_no=pindex, step=step)
+
+                if(objectCorrectionMatrix):
+                    pt = pt + loc
+
+                if not pt.length_squared == 0:
+                    raw[num_points + length] = pt
+                    length += 1
+                else:
+                    # this strand ends prematurely
+                    break
 
-        if len(strand_points) > 1:
-            # double the first and last
-            strand_points = strand_points[:3] + \
-                strand_points + strand_points[-3:]
-            vertsInStrand = len(strand_points) // 3
-            # for varying width make the width array
-            if not conwidth:
-                decr = (base_width - tip_width) / (vertsInStrand - 2)
-                hair_width.extend([base_width] + [(base_width - decr * i)
-                                                  for i in range(vertsInStrand - 2)] +
-                                  [tip_width])
-
-            # add the last point again
-            points.extend(strand_points)
-            vertsArray.append(vertsInStrand)
-            nverts += vertsInStrand
+            if length == 0:
+                continue
+            lengths[num_strands] = length
 
             # get the scalp S
             if export_st:
                 if pindex >= num_parents:
-                    particle = psys.particles[
-                        (pindex - num_parents) % num_parents]
+                    particle = particles[(pindex - num_parents) % num_parents]
                 else:
-                    particle = psys.particles[pindex]
+                    particle = particles[pindex]
                 st = psys.uv_on_emitter(psys_modifier, particle, pindex)
-                scalpS.append(st[0])
-                scalpT.append(st[1])
-
-        # if we get more than 100000 vertices, export ri.Curve and reset.  This
-        # is to avoid a maxint on the array length
-        if nverts > 100000:
-            curve_sets.append(
-                (vertsArray, points, widthString, hair_width, scalpS, scalpT))
-
-            nverts = 0
-            points = []
-            vertsArray = []
-            if not conwidth:
-                hair_width = []
-            scalpS = []
-            scalpT = []
-
-    if nverts > 0:
-        curve_sets.append((vertsArray, points, widthString,
-                           hair_width, scalpS, scalpT))
-
-    psys.set_resolution(scene=scene, object=ob, resolution='PREVIEW')
+                scalpS[num_strands] = st[0]
+                scalpT[num_strands] = st[1]
+
+            num_strands += 1
+            num_points += length
+            nverts += length + 2
+
+            if nverts > HAIR_CHUNK_VERTS:
+                yield get_chunk()
+                num_strands = 0
+                num_points = 0
+                nverts = 0
+
+        if nverts > 0:
+            yield get_chunk()
+    finally:
+        psys.set_resolution(scene=scene, object=ob, resolution='PREVIEW')
+
+
+# the curve sets of one hair motion sample.  they are kept in a temporary
+# file instead of memory, and read back one chunk at a time when the motion
+# blocks are written
+class HairSample:
+
+    def __init__(self, curve_sets):
+        fd, self.path = tempfile.mkstemp(prefix='rman_hair_', suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            for curve_set in curve_sets:
+                pickle.dump(curve_set, f, pickle.HIGHEST_PROTOCOL)
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
 
-    return curve_sets
+    def free(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
 
 # only export particles that are alive,
 # or have been born since the last frame
@@ -396,110 +481,232 @@ def valid_particle(pa, valid_frames):
     return pa.die_time >= valid_frames[-1] and pa.birth_time <= valid_frames[0]
 
 
-def get_particles(scene, ob, psys, valid_frames=None):
-    P = []
-    rot = []
-    width = []
+# number of floats foreach_get returns per particle for each attribute
+PARTICLE_ATTRIBUTES = {'location': 3, 'rotation': 4, 'size': 1,
+                       'velocity': 3, 'angular_velocity': 3,
+                       'birth_time': 1, 'die_time': 1, 'lifetime': 1}
+
+
+def read_particles(particles, attr):
+    size = PARTICLE_ATTRIBUTES[attr]
+    buf = np.empty(len(particles) * size, dtype=np.float32)
+    particles.foreach_get(attr, buf)
+    return buf.reshape(-1, size) if size > 1 else buf
+
+
+def get_particles_alive(particles):
+    alive = np.empty(len(particles), dtype=np.int32)
+    try:
+        particles.foreach_get('alive_state', alive)
+    except (TypeError, RuntimeError):
+        # older blenders can't bulk read enums
+        return np.fromiter((pa.alive_state == 'ALIVE' for pa in particles),
+                           dtype=bool, count=len(particles))
+    alive_value = bpy.types.Particle.bl_rna.properties['alive_state'] \
+        .enum_items['ALIVE'].value
+    return alive == alive_value
+
+
+# the particles that are alive in valid_frames, or have been born since the
+# last frame.  attributes are read with one foreach_get each the first time
+# they are asked for, and come back masked to the valid particles
+class ParticleSnapshot:
+
+    def __init__(self, psys, valid_frames):
+        self.particles = psys.particles
+        self.attributes = {}
+        self.mask = (read_particles(self.particles, 'die_time') >=
+                     valid_frames[-1]) & \
+            (read_particles(self.particles, 'birth_time') <= valid_frames[0])
+
+    def get(self, attr):
+        if attr not in self.attributes:
+            self.attributes[attr] = \
+                read_particles(self.particles, attr)[self.mask]
+        return self.attributes[attr]
 
+    def alive(self):
+        return get_particles_alive(self.particles)[self.mask]
+
+    def ids(self):
+        return np.flatnonzero(self.mask)
+
+
+def get_particles(scene, ob, psys, valid_frames=None):
     valid_frames = (scene.frame_current,
                     scene.frame_current) if valid_frames is None else valid_frames
     psys.set_resolution(scene, ob, 'RENDER')
-    for pa in [p for p in psys.particles if valid_particle(p, valid_frames)]:
-        P.extend(pa.location)
-        rot.extend(pa.rotation)
-
-        if pa.alive_state != 'ALIVE':
-            width.append(0.0)
-        else:
-            width.append(pa.size)
+    snapshot = ParticleSnapshot(psys, valid_frames)
+    P = snapshot.get('location').reshape(-1)
+    rot = snapshot.get('rotation').reshape(-1)
+    width = np.where(snapshot.alive(), snapshot.get('size'),
+                     0.0).astype(np.float32)
     psys.set_resolution(scene, ob, 'PREVIEW')
     return (P, rot, width)
 
 
 def get_mesh(mesh, get_normals=False):
-    nverts = []
-    verts = []
-    P = []
-    N = []
-
-    for v in mesh.vertices:
-        P.extend(v.co)
-
-    for p in mesh.polygons:
-        nverts.append(p.loop_total)
-        verts.extend(p.vertices)
-        if get_normals:
-            if p.use_smooth:
-                for vi in p.vertices:
-                    N.extend(mesh.vertices[vi].normal)
-            else:
-                N.extend(list(p.normal) * p.loop_total)
+    # pull everything out with foreach_get into flat typed buffers,
+    # much faster than walking the RNA collections one element at a time
+    num_verts = len(mesh.vertices)
+    num_polys = len(mesh.polygons)
+    num_loops = len(mesh.loops)
+
+    P = np.empty(num_verts * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', P)
+
+    nverts = np.empty(num_polys, dtype=np.int32)
+    mesh.polygons.foreach_get('loop_total', nverts)
+
+    verts = np.empty(num_loops, dtype=np.int32)
+    mesh.loops.foreach_get('vertex_index', verts)
+
+    # loops are normally stored in polygon order, but if they are not
+    # gather them back into the order of mesh.polygons
+    loop_start = np.empty(num_polys, dtype=np.int32)
+    mesh.polygons.foreach_get('loop_start', loop_start)
+    loop_order = get_polygon_loop_order(nverts, loop_start)
+    if loop_order is not None:
+        verts = verts[loop_order]
+
+    N = np.empty(0, dtype=np.float32)
+    if get_normals and num_polys:
+        vertex_normals = np.empty(num_verts * 3, dtype=np.float32)
+        mesh.vertices.foreach_get('normal', vertex_normals)
+        poly_normals = np.empty(num_polys * 3, dtype=np.float32)
+        mesh.polygons.foreach_get('normal', poly_normals)
+        smooth = np.empty(num_polys, dtype=bool)
+        mesh.polygons.foreach_get('use_smooth', smooth)
+
+        # smooth faces use the vertex normals, flat ones the face normal
+        # repeated for every corner
+        loop_smooth = np.repeat(smooth, nverts)
+        N = np.where(loop_smooth[:, np.newaxis],
+                     vertex_normals.reshape(-1, 3)[verts],
+                     np.repeat(poly_normals.reshape(-1, 3), nverts, axis=0))
+        N = N.ravel()
 
     if len(verts) > 0:
-        P = P[:int(max(verts) + 1) * 3]
+        P = P[:int(verts.max() + 1) * 3]
     # return the P's minus any unconnected
     return (nverts, verts, P, N)
 
 
-# requires facevertex interpolation
-def get_mesh_uv(mesh, name="", flipvmode='NONE'):
-    uvs = []
+# return an index array that puts the loops in polygon order,
+# or None if they already are
+def get_polygon_loop_order(nverts, loop_start):
+    expected_start = np.zeros(len(nverts), dtype=np.int64)
+    np.cumsum(nverts[:-1], out=expected_start[1:])
+    if np.array_equal(expected_start, loop_start):
+        return None
+    # loop_start[p] + 0..loop_total[p]-1 for each polygon p
+    offsets = np.arange(int(nverts.sum())) - np.repeat(expected_start, nverts)
+    return np.repeat(loop_start, nverts) + offsets
+
+
+# return the loop order for a mesh, see get_polygon_loop_order
+def get_mesh_loop_order(mesh):
+    num_polys = len(mesh.polygons)
+    nverts = np.empty(num_polys, dtype=np.int32)
+    mesh.polygons.foreach_get('loop_total', nverts)
+    loop_start = np.empty(num_polys, dtype=np.int32)
+    mesh.polygons.foreach_get('loop_start', loop_start)
+    return get_polygon_loop_order(nverts, loop_start)
+
+
+# a hash of the faces of a mesh, samples with the same topology can be
+# exported in one motion block
+def get_mesh_topology(nverts, verts):
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(nverts, dtype=np.int32).tobytes())
+    h.update(b'|')
+    h.update(np.ascontiguousarray(verts, dtype=np.int32).tobytes())
+    return h.hexdigest()
+
+
+# the points (and normals if asked for) of a deforming mesh at one motion
+# sample.  everything else is shared by all the samples, so it is read from
+# the mesh the samples are exported with, which is set as the mesh attribute
+class MeshSample:
+
+    def __init__(self, mesh, get_normals=False):
+        nverts, verts, self.P, self.N = get_mesh(mesh, get_normals)
+        self.topology = get_mesh_topology(nverts, verts)
+        self.mesh = None
+
+
+def get_mesh_uv_layer(mesh, name=""):
     if not name:
-        uv_loop_layer = mesh.uv_layers.active
-    else:
-        # assuming uv loop layers and uv textures share identical indices
-        idx = mesh.uv_textures.keys().index(name)
-        uv_loop_layer = mesh.uv_layers[idx]
+        return mesh.uv_layers.active
+    # assuming uv loop layers and uv textures share identical indices
+    idx = mesh.uv_textures.keys().index(name)
+    return mesh.uv_layers[idx]
 
-    if uv_loop_layer is None:
-        return None
 
-    for uvloop in uv_loop_layer.data:
-        uvs.append(uvloop.uv.x)
-        # renderman expects UVs flipped vertically from blender
-        # best to do this in pattern, provided here as additional option
-        if flipvmode == 'UV':
-            uvs.append(1.0-uvloop.uv.y)
-        elif flipvmode == 'TILE':
-            uvs.append(math.ceil(uvloop.uv.y) - uvloop.uv.y + math.floor(uvloop.uv.y))
-        elif flipvmode == 'NONE':
-            uvs.append(uvloop.uv.y)
+def get_mesh_vcol_layer(mesh, name=""):
+    return mesh.vertex_colors[name] if name != "" \
+        else mesh.vertex_colors.active
+
+
+# requires facevertex interpolation
+def get_mesh_uv(uv_loop_layer, flipvmode='NONE', loop_order=None):
+    uvs = np.empty(len(uv_loop_layer.data) * 2, dtype=np.float32)
+    uv_loop_layer.data.foreach_get('uv', uvs)
+    if loop_order is not None:
+        uvs = uvs.reshape(-1, 2)[loop_order].ravel()
+
+    # renderman expects UVs flipped vertically from blender
+    # best to do this in pattern, provided here as additional option
+    v = uvs[1::2]
+    if flipvmode == 'UV':
+        uvs[1::2] = 1.0 - v
+    elif flipvmode == 'TILE':
+        uvs[1::2] = np.ceil(v) - v + np.floor(v)
 
     return uvs
 
 
 # requires facevertex interpolation
-def get_mesh_vcol(mesh, name=""):
-    vcol_layer = mesh.vertex_colors[name] if name != "" \
-        else mesh.vertex_colors.active
-    cols = []
+def get_mesh_vcol(vcol_layer, loop_order=None):
+    num_loops = len(vcol_layer.data)
+    if num_loops == 0:
+        return np.empty(0, dtype=np.float32)
 
-    if vcol_layer is None:
-        return None
+    # only rgb goes out, even if the layer stores alpha
+    num_channels = len(vcol_layer.data[0].color)
+    cols = np.empty(num_loops * num_channels, dtype=np.float32)
+    vcol_layer.data.foreach_get('color', cols)
+    cols = cols.reshape(-1, num_channels)
+    if loop_order is not None:
+        cols = cols[loop_order]
 
-    for vcloop in vcol_layer.data:
-        cols.extend(vcloop.color)
+    return cols[:, :3].ravel()
 
-    return cols
 
 # requires per-vertex interpolation
+# weights for several vertex groups are gathered in a single pass over the
+# vertices, returns a dict of vertex group index to weights
+def get_mesh_vgroups(mesh, vgroups):
+    weights = dict((vgroup.index, np.zeros(len(mesh.vertices),
+                                           dtype=np.float32))
+                   for vgroup in vgroups)
+    if not weights:
+        return weights
+
+    for i, v in enumerate(mesh.vertices):
+        for g in v.groups:
+            group_weights = weights.get(g.group)
+            if group_weights is not None:
+                group_weights[i] = g.weight
 
+    return weights
 
-def get_mesh_vgroup(ob, mesh, name=""):
-    vgroup = ob.vertex_groups[name] if name != "" else ob.vertex_groups.active
-    weights = []
-
-    if vgroup is None:
-        return None
 
-    for v in mesh.vertices:
-        if len(v.groups) == 0:
-            weights.append(0.0)
-        else:
-            weights.extend([g.weight for g in v.groups
-                            if g.group == vgroup.index])
+def get_mesh_material_ids(mesh):
+    mat_ids = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get('material_index', mat_ids)
+    return mat_ids
 
-    return weights
 
 # if a mesh has more than one material
 
@@ -508,11 +715,8 @@ def is_multi_material(mesh):
     if type(mesh) != bpy.types.Mesh or len(mesh.materials) < 2 \
             or len(mesh.polygons) == 0:
         return False
-    first_mat = mesh.polygons[0].material_index
-    for p in mesh.polygons:
-        if p.material_index != first_mat:
-            return True
-    return False
+    mat_ids = get_mesh_material_ids(mesh)
+    return bool((mat_ids != mat_ids[0]).any())
 
 
 def get_primvars(ob, geo, interpolation=""):
@@ -526,85 +730,101 @@ def get_primvars(ob, geo, interpolation=""):
 
     # get material id if this is a multi-material mesh
     if is_multi_material(geo):
-        primvars["uniform float material_id"] = rib([p.material_index
-                                                     for p in geo.polygons])
+        primvars["uniform float material_id"] = get_mesh_material_ids(geo)
+
+    # every layer is only read once, even if it is used by
+    # several primvars
+    loop_order = get_mesh_loop_order(geo)
+    uv_data = {}
+    vcol_data = {}
+
+    def uvs_for(name=""):
+        layer = get_mesh_uv_layer(geo, name)
+        if layer is None:
+            return None
+        if layer.name not in uv_data:
+            uv_data[layer.name] = get_mesh_uv(layer, rm.export_flipv,
+                                              loop_order)
+        return uv_data[layer.name]
+
+    def vcols_for(name=""):
+        layer = get_mesh_vcol_layer(geo, name)
+        if layer is None:
+            return None
+        if layer.name not in vcol_data:
+            vcol_data[layer.name] = get_mesh_vcol(layer, loop_order)
+        return vcol_data[layer.name]
 
     if rm.export_default_uv:
-        uvs = get_mesh_uv(geo, flipvmode=rm.export_flipv)
-        if uvs and len(uvs) > 0:
+        uvs = uvs_for()
+        if uvs is not None and len(uvs) > 0:
             primvars["%s float[2] st" % interpolation] = uvs
     if rm.export_default_vcol:
-        vcols = get_mesh_vcol(geo)
-        if vcols and len(vcols) > 0:
-            primvars["%s color Cs" % interpolation] = rib(vcols)
+        vcols = vcols_for()
+        if vcols is not None and len(vcols) > 0:
+            primvars["%s color Cs" % interpolation] = vcols
+
+    # vertex group weights share one pass over the vertices
+    vgroup_vars = []
+    for p in rm.prim_vars:
+        if p.data_source == 'VERTEX_GROUP':
+            vgroup = ob.vertex_groups.get(p.data_name) if p.data_name != "" \
+                else ob.vertex_groups.active
+            if vgroup is not None:
+                vgroup_vars.append((p, vgroup))
+    weights = get_mesh_vgroups(geo, [vgroup for p, vgroup in vgroup_vars])
 
     # custom prim vars
     for p in rm.prim_vars:
         if p.data_source == 'VERTEX_COLOR':
-            vcols = get_mesh_vcol(geo, p.data_name)
-            if vcols and len(vcols) > 0:
-                primvars["%s color %s" % (interpolation, p.name)] = rib(vcols)
+            vcols = vcols_for(p.data_name)
+            if vcols is not None and len(vcols) > 0:
+                primvars["%s color %s" % (interpolation, p.name)] = vcols
 
         elif p.data_source == 'UV_TEXTURE':
-            uvs = get_mesh_uv(geo, p.data_name, flipvmode=rm.export_flipv)
-            if uvs and len(uvs) > 0:
+            uvs = uvs_for(p.data_name)
+            if uvs is not None and len(uvs) > 0:
                 primvars["%s float[2] %s" % (interpolation, p.name)] = uvs
 
-        elif p.data_source == 'VERTEX_GROUP':
-            weights = get_mesh_vgroup(ob, geo, p.data_name)
-            if weights and len(weights) > 0:
-                primvars["vertex float %s" % p.name] = weights
+    for p, vgroup in vgroup_vars:
+        if len(weights[vgroup.index]) > 0:
+            primvars["vertex float %s" % p.name] = weights[vgroup.index]
 
     return primvars
 
 
+# convert any array primvars to something ri can take
+def rib_primvars(primvars):
+    return dict((key, rib(val)) for key, val in primvars.items())
+
+
 def get_primvars_particle(scene, psys, subframes):
     primvars = {}
     rm = psys.settings.renderman
     cfra = scene.frame_current
+    snapshot = ParticleSnapshot(psys, subframes)
 
     for p in rm.prim_vars:
-        pvars = []
-
-        if p.data_source in ('VELOCITY', 'ANGULAR_VELOCITY'):
-            if p.data_source == 'VELOCITY':
-                for pa in \
-                        [p for p in psys.particles if valid_particle(p, subframes)]:
-                    pvars.extend(pa.velocity)
-            elif p.data_source == 'ANGULAR_VELOCITY':
-                for pa in \
-                        [p for p in psys.particles if valid_particle(p, subframes)]:
-                    pvars.extend(pa.angular_velocity)
-
-            primvars["uniform float[3] %s" % p.name] = pvars
-
-        elif p.data_source in \
-                ('SIZE', 'AGE', 'BIRTH_TIME', 'DIE_TIME', 'LIFE_TIME', 'ID'):
-            if p.data_source == 'SIZE':
-                for pa in \
-                        [p for p in psys.particles if valid_particle(p, subframes)]:
-                    pvars.append(pa.size)
-            elif p.data_source == 'AGE':
-                for pa in \
-                        [p for p in psys.particles if valid_particle(p, subframes)]:
-                    pvars.append((cfra - pa.birth_time) / pa.lifetime)
-            elif p.data_source == 'BIRTH_TIME':
-                for pa in \
-                        [p for p in psys.particles if valid_particle(p, subframes)]:
-                    pvars.append(pa.birth_time)
-            elif p.data_source == 'DIE_TIME':
-                for pa in \
-                        [p for p in psys.particles if valid_particle(p, subframes)]:
-                    pvars.append(pa.die_time)
-            elif p.data_source == 'LIFE_TIME':
-                for pa in \
-                        [p for p in psys.particles if valid_particle(p, subframes)]:
-                    pvars.append(pa.lifetime)
-            elif p.data_source == 'ID':
-                pvars = [id for id, p in psys.particles.items(
-                ) if valid_particle(p, subframes)]
-
-            primvars["varying float %s" % p.name] = pvars
+        if p.data_source == 'VELOCITY':
+            primvars["uniform float[3] %s" % p.name] = \
+                snapshot.get('velocity').reshape(-1)
+        elif p.data_source == 'ANGULAR_VELOCITY':
+            primvars["uniform float[3] %s" % p.name] = \
+                snapshot.get('angular_velocity').reshape(-1)
+
+        elif p.data_source == 'SIZE':
+            primvars["varying float %s" % p.name] = snapshot.get('size')
+        elif p.data_source == 'AGE':
+            primvars["varying float %s" % p.name] = \
+                (cfra - snapshot.get('birth_time')) / snapshot.get('lifetime')
+        elif p.data_source == 'BIRTH_TIME':
+            primvars["varying float %s" % p.name] = snapshot.get('birth_time')
+        elif p.data_source == 'DIE_TIME':
+            primvars["varying float %s" % p.name] = snapshot.get('die_time')
+        elif p.data_source == 'LIFE_TIME':
+            primvars["varying float %s" % p.name] = snapshot.get('lifetime')
+        elif p.data_source == 'ID':
+            primvars["varying float %s" % p.name] = snapshot.ids()
 
     return primvars
 
@@ -621,8 +841,9 @@ def get_fluid_mesh(scene, ob):
     removeMeshFromMemory(mesh.name)
 
     # use fluid vertex velocity vectors to reconstruct moving points
-    P = [P[i] + fluidmeshverts[int(i / 3)].velocity[i % 3] * subframe * 0.5 for
-         i in range(len(P))]
+    velocity = np.empty(len(fluidmeshverts) * 3, dtype=np.float32)
+    fluidmeshverts.foreach_get('velocity', velocity)
+    P = P + velocity[:len(P)] * subframe * 0.5
 
     return (nverts, verts, P, N)
 
@@ -953,16 +1174,28 @@ def export_motion_end(ri, motion_data):
         ri.MotionEnd()
 
 
+def export_hair_curves(ri, curve_set):
+    vertsArray, points, widthString, widths, scalpS, scalpT = curve_set
+    params = {"P": rib(points), widthString: rib(widths), 'uniform integer index': range(len(vertsArray))}
+    if len(scalpS):
+        params['uniform float scalpS'] = rib(scalpS)
+        params['uniform float scalpT'] = rib(scalpT)
+    ri.Curves("cubic", rib(vertsArray), "nonperiodic", params)
+
+
+# with motion samples every chunk gets its own motion block, reading one
+# chunk from each sample at a time
 def export_hair(ri, scene, ob, psys, data, objectCorrectionMatrix=False):
-    curves = data if data else get_strands(
-        scene, ob, psys, objectCorrectionMatrix)
+    if not data:
+        for curve_set in iter_strands(scene, ob, psys, objectCorrectionMatrix):
+            export_hair_curves(ri, curve_set)
+        return
 
-    for vertsArray, points, widthString, widths, scalpS, scalpT in curves:
-        params = {"P": rib(points), widthString: widths, 'uniform integer index': range(len(vertsArray))}
-        if len(scalpS):
-            params['uniform float scalpS'] = scalpS
-            params['uniform float scalpT'] = scalpT
-        ri.Curves("cubic", vertsArray, "nonperiodic", params)
+    for curve_sets in zip(*[sample for subframe, sample in data]):
+        export_motion_begin(ri, data)
+        for curve_set in curve_sets:
+            export_hair_curves(ri, curve_set)
+        export_motion_end(ri, data)
 
 
 def geometry_source_rib(ri, scene, ob):
@@ -1010,6 +1243,15 @@ def geometry_source_rib(ri, scene, ob):
                       params)
 
 
+# blobby opcodes for count ellipsoids, each with its own transform, all
+# added together
+def get_blobby_ops(count):
+    ellipsoids = np.empty((count, 2), dtype=np.int32)
+    ellipsoids[:, 0] = 1001  # only blobby ellipsoids for now...
+    ellipsoids[:, 1] = np.arange(count) * 16
+    return ellipsoids.reshape(-1).tolist() + [0, count] + list(range(count))
+
+
 def export_blobby_particles(ri, scene, psys, ob, motion_data):
     rm = psys.settings.renderman
     if len(motion_data) > 1:
@@ -1018,38 +1260,73 @@ def export_blobby_particles(ri, scene, psys, ob, motion_data):
     subframes = [scene.frame_current + i for (i, data) in motion_data]
 
     for (i, (P, rot, widths)) in motion_data:
-        op = []
         count = len(widths)
-        for i in range(count):
-            op.append(1001)  # only blobby ellipsoids for now...
-            op.append(i * 16)
-        tform = []
-        for i in range(count):
-            loc = Vector((P[i * 3 + 0], P[i * 3 + 1], P[i * 3 + 2]))
-            rotation = Quaternion((rot[i * 4 + 0], rot[i * 4 + 1],
-                                   rot[i * 4 + 2], rot[i * 4 + 3]))
-            scale = rm.width if rm.constant_width else widths[i]
-            mtx = Matrix.Translation(loc) * rotation.to_matrix().to_4x4() \
-                * Matrix.Scale(scale, 4)
-            tform.extend(rib(mtx))
-
-        op.append(0)  # blob operation:add
-        op.append(count)
-        for n in range(count):
-            op.append(n)
+        scale = np.full(count, rm.width) if rm.constant_width else widths
+        tform = get_particle_transforms(P, rot, scale)
 
         st = ('',)
-        parm = get_primvars_particle(scene, psys, subframes)
-        ri.Blobby(count, op, tform, st, parm)
+        parm = rib_primvars(get_primvars_particle(scene, psys, subframes))
+        ri.Blobby(count, get_blobby_ops(count), rib(tform.reshape(-1)), st,
+                  parm)
     if len(motion_data) > 1:
         ri.MotionEnd()
 
 
+# the transform of every particle as a row of 16 floats in rib order,
+# translate * rotate * scale like the matrices built per particle
+def get_particle_transforms(P, rot, scale):
+    loc = P.reshape(-1, 3)
+    w, x, y, z = rot.reshape(-1, 4).T
+    mtx = np.zeros((len(loc), 4, 4), dtype=np.float32)
+    mtx[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    mtx[:, 0, 1] = 2 * (x * y - w * z)
+    mtx[:, 0, 2] = 2 * (x * z + w * y)
+    mtx[:, 1, 0] = 2 * (x * y + w * z)
+    mtx[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    mtx[:, 1, 2] = 2 * (y * z - w * x)
+    mtx[:, 2, 0] = 2 * (x * z - w * y)
+    mtx[:, 2, 1] = 2 * (y * z + w * x)
+    mtx[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    mtx[:, :3, :3] *= np.asarray(scale, dtype=np.float32).reshape(-1, 1, 1)
+    mtx[:, :3, 3] = loc
+    mtx[:, 3, 3] = 1.0
+    return mtx.transpose(0, 2, 1).reshape(-1, 16)
+
+
+# all transforms and user attributes are computed up front, each particle
+# only gets its instance and what differs from the others
+def export_particle_instance_batch(ri, rm, motion_data, params, instance_handle):
+    num_points = len(motion_data[0][1][2])
+    tforms = []
+    for (seg, (P, rot, point_width)) in motion_data:
+        scale = np.full(num_points, rm.width) if rm.constant_width \
+            else point_width
+        tforms.append(get_particle_transforms(P, rot, scale).tolist())
+    user_params = [(param, values.tolist()) for param, values in params.items()]
+
+    for i in range(num_points):
+        ri.AttributeBegin()
+        export_motion_begin(ri, motion_data)
+        for tform in tforms:
+            ri.Transform(tform[i])
+        export_motion_end(ri, motion_data)
+        if user_params:
+            ri.Attribute("user", dict((param, values[i])
+                                      for param, values in user_params))
+        ri.ObjectInstance(instance_handle)
+        ri.AttributeEnd()
+
+
 def export_particle_instances(ri, scene, rpass, psys, ob, motion_data, type='OBJECT'):
     rm = psys.settings.renderman
 
     params = get_primvars_particle(
         scene, psys, [scene.frame_current + i for (i, data) in motion_data])
+    # one row of values per particle
+    for name, values in params.items():
+        size = primvar_item_len(name)
+        if size > 1:
+            params[name] = values.reshape(-1, size)
 
     if type == 'OBJECT':
         master_ob = bpy.data.objects[rm.particle_instance_object]
@@ -1070,6 +1347,11 @@ def export_particle_instances(ri, scene, rpass, psys, ob, motion_data, type='OBJ
     if type == 'OBJECT' and rm.use_object_material and len(master_ob.data.materials) > 0:
         export_material_archive(ri, master_ob.data.materials[0])
 
+    if rm.instance_mode == 'BATCH':
+        export_particle_instance_batch(ri, rm, motion_data, params,
+                                       instance_handle)
+        return
+
     width = rm.width
 
     num_points = len(motion_data[0][1][2])
@@ -1093,8 +1375,8 @@ def export_particle_instances(ri, scene, rpass, psys, ob, motion_data, type='OBJ
             ri.MotionEnd()
 
         instance_params = {}
-        for param in params:
-            instance_params[param] = params[param][i]
+        for param, values in params.items():
+            instance_params[param] = values[i].tolist()
 
         ri.Attribute("user", instance_params)
 
@@ -1111,14 +1393,14 @@ def export_particle_points(ri, scene, psys, ob, motion_data, objectCorrectionMat
         export_motion_begin(ri, motion_data)
 
     for (i, (P, rot, width)) in motion_data:
-        params = get_primvars_particle(
-            scene, psys, [scene.frame_current + i for (i, data) in motion_data])
+        params = rib_primvars(get_primvars_particle(
+            scene, psys, [scene.frame_current + i for (i, data) in motion_data]))
         params[ri.P] = rib(P)
         params["uniform string type"] = rm.particle_type
         if rm.constant_width:
             params["constantwidth"] = rm.width
         elif rm.export_default_size:
-            params["varying float width"] = width
+            params["varying float width"] = rib(width)
         ri.Points(params)
 
     if len(motion_data) > 1:
@@ -1175,14 +1457,13 @@ def get_texture_list(scene):
         if o.type == 'CAMERA' or o.type == 'EMPTY':
             continue
         elif o.type == 'LAMP':
-            if o.data.renderman.get_light_node():
-                textures = textures + \
-                    get_textures_for_node(o.data.renderman.get_light_node())
+            textures.extend(get_light_textures(
+                o.data.renderman.get_light_node()))
         else:
             mats_to_scan += recursive_texture_set(o)
     if scene.world and scene.world.renderman.renderman_type != 'NONE':
-        textures = textures + \
-            get_textures_for_node(scene.world.renderman.get_light_node())
+        textures.extend(get_light_textures(
+            scene.world.renderman.get_light_node()))
 
     # cull duplicates by only doing mats once
     for mat in set(mats_to_scan):
@@ -1192,6 +1473,12 @@ def get_texture_list(scene):
     return textures
 
 
+# textures carry their txmake options as a list, this is their hashable form
+def texture_key(texture):
+    in_file, out_file, options = texture
+    return (in_file, out_file, tuple(options))
+
+
 def get_select_texture_list(object):
     textures = []
     for mat in set(recursive_texture_set(object)):
@@ -1324,17 +1611,20 @@ def export_curve(ri, scene, ob, data):
 
 
 def export_subdivision_mesh(ri, scene, ob, data=None):
-    mesh = data if data is not None else create_mesh(ob, scene)
+    mesh = data.mesh if data is not None else create_mesh(ob, scene)
 
     # if is_multi_material(mesh):
     #    export_multi_material(ri, mesh)
 
     creases = get_subd_creases(mesh)
     (nverts, verts, P, N) = get_mesh(mesh)
+    if data is not None:
+        P = data.P
     # if this is empty continue:
-    if nverts == []:
+    if len(nverts) == 0:
         debug("error empty subdiv mesh %s" % ob.name)
-        removeMeshFromMemory(mesh.name)
+        if data is None:
+            removeMeshFromMemory(mesh.name)
         return
     tags = ['interpolateboundary', 'facevaryinginterpolateboundary']
     nargs = [1, 0, 1, 0]
@@ -1353,8 +1643,8 @@ def export_subdivision_mesh(ri, scene, ob, data=None):
                 intargs.extend([c[0], c[1]])
                 floatargs.append(c[2])
 
-        ri.SubdivisionMesh("catmull-clark", nverts, verts, tags, nargs,
-                           intargs, floatargs, primvars)
+        ri.SubdivisionMesh("catmull-clark", rib(nverts), rib(verts), tags,
+                           nargs, intargs, floatargs, rib_primvars(primvars))
     else:
         nargs = [1, 0, 0, 1, 0, 0]
         if len(creases) > 0:
@@ -1369,104 +1659,121 @@ def export_subdivision_mesh(ri, scene, ob, data=None):
                 get_mats_faces(nverts, primvars).items():
             tags.append("faceedit")
             nargs.extend([2 * len(faces), 0, 3])
-            for face in faces:
-                intargs.extend([1, face])
+            face_args = np.empty((len(faces), 2), dtype=np.int64)
+            face_args[:, 0] = 1
+            face_args[:, 1] = faces
+            intargs.extend(face_args.ravel().tolist())
             export_material_archive(ri, mesh.materials[mat_id])
             ri.Resource(mesh.materials[mat_id].name, "attributes",
                         {'string operation': 'save',
                          'string subset': 'shading'})
             string_args.extend(['attributes', mesh.materials[mat_id].name,
                                 'shading'])
-        ri.HierarchicalSubdivisionMesh("catmull-clark", nverts, verts, tags, nargs,
-                                       intargs, floatargs, string_args, primvars)
+        ri.HierarchicalSubdivisionMesh("catmull-clark", rib(nverts), rib(verts),
+                                       tags, nargs, intargs, floatargs,
+                                       string_args, rib_primvars(primvars))
+
+    if data is None:
+        removeMeshFromMemory(mesh.name)
 
-    removeMeshFromMemory(mesh.name)
 
+# number of values per item for a primvar declaration
+# such as "facevarying float[2] st"
+def primvar_item_len(key):
+    item_type = key.split()[1]
+    if "int" in item_type or "float" in item_type:
+        if "[" in item_type:
+            return int(item_type.split('[')[1].split(']')[0])
+        return 1
+    return 3
 
+
+# for each material id, the sorted array of faces using it
 def get_mats_faces(nverts, primvars):
     if "uniform float material_id" not in primvars:
         return {}
 
     else:
-        mats = {}
+        mat_ids = np.asarray(primvars["uniform float material_id"])
+        faces = np.argsort(mat_ids, kind='stable')
+        unique_ids, first_faces = np.unique(mat_ids[faces],
+                                            return_index=True)
+        return dict((int(mat_id), mat_faces) for mat_id, mat_faces in
+                    zip(unique_ids, np.split(faces, first_faces[1:])))
+
 
-        for face_id, num_verts in enumerate(nverts):
-            mat_id = primvars["uniform float material_id"][face_id]
-            if mat_id not in mats:
-                mats[mat_id] = []
-            mats[mat_id].append(face_id)
-        return mats
+# corner indices for faces, in the order of the faces
+def get_faces_loops(nverts, face_start, faces):
+    face_nverts = nverts[faces]
+    corner_start = np.zeros(len(faces), dtype=np.int64)
+    np.cumsum(face_nverts[:-1], out=corner_start[1:])
+    offsets = np.arange(int(face_nverts.sum())) - \
+        np.repeat(corner_start, face_nverts)
+    return np.repeat(face_start[faces], face_nverts) + offsets
 
 
 def split_multi_mesh(nverts, verts, primvars):
     if "uniform float material_id" not in primvars:
         return {0: (nverts, verts, primvars)}
     else:
-        meshes = {}
-        vert_index = 0
-        for face_id, num_verts in enumerate(nverts):
-            mat_id = primvars["uniform float material_id"][face_id]
-            if mat_id not in meshes:
-                meshes[mat_id] = ([], [], {'P': []})
-                for key, val in primvars.items():
-                    if "facevarying" not in key:
-                        continue
-                    meshes[mat_id][2][key] = []
+        nverts = np.asarray(nverts)
+        verts = np.asarray(verts)
+        P = np.asarray(primvars['P']).reshape(-1, 3)
 
-            meshes[mat_id][0].append(num_verts)
-            meshes[mat_id][1].extend(verts[vert_index:vert_index + num_verts])
-            for key, val in primvars.items():
-                if "facevarying" not in key:
-                    continue
-                item_len = 3
-                item_type = key.split()[1]
-                if "int" in item_type or "float" in item_type:
-                    item_len = 1
-                    if "[" in item_type:
-                        item_len = int(item_type.split('[')[1].split(']')[0])
-                meshes[mat_id][2][key].extend(
-                    primvars[key][vert_index * item_len:
-                                  vert_index * item_len + num_verts * item_len])
-            vert_index += num_verts
-
-        # now sort the verts and replace
-        for mat_id, mat_mesh in meshes.items():
-            unique_verts = sorted(set(mat_mesh[1]))
-            vert_mapping = [0] * len(verts)
-            for i, v_index in enumerate(unique_verts):
-                vert_mapping[v_index] = i
-                mat_mesh[2]['P'].extend(
-                    primvars['P'][int(v_index * 3):int(v_index * 3) + 3])
-
-            for i, vert_old in enumerate(mat_mesh[1]):
-                mat_mesh[1][i] = vert_mapping[vert_old]
+        face_start = np.zeros(len(nverts), dtype=np.int64)
+        np.cumsum(nverts[:-1], out=face_start[1:])
+
+        # parse the facevarying primvar types once, not per face
+        facevarying = [(key, np.asarray(val).reshape(-1, primvar_item_len(key)))
+                       for key, val in primvars.items() if "facevarying" in key]
+
+        meshes = {}
+        for mat_id, faces in get_mats_faces(nverts, primvars).items():
+            loops = get_faces_loops(nverts, face_start, faces)
+
+            # compact the vertices used by this material, keeping
+            # them in their original order
+            unique_verts, mat_verts = np.unique(verts[loops],
+                                                return_inverse=True)
+            mat_primvars = {'P': P[unique_verts].ravel()}
+            for key, val in facevarying:
+                mat_primvars[key] = val[loops].ravel()
+
+            meshes[mat_id] = (nverts[faces], mat_verts.ravel(), mat_primvars)
         return meshes
 
 
 def export_polygon_mesh(ri, scene, ob, data=None):
     debug("info", "export_polygon_mesh [%s]" % ob.name)
 
-    mesh = data if data is not None else create_mesh(ob, scene)
+    mesh = data.mesh if data is not None else create_mesh(ob, scene)
 
     # for multi-material output all those
-    (nverts, verts, P, N) = get_mesh(mesh, get_normals=True)
+    if data is not None:
+        (nverts, verts, P, N) = get_mesh(mesh)
+        P, N = data.P, data.N
+    else:
+        (nverts, verts, P, N) = get_mesh(mesh, get_normals=True)
     # if this is empty continue:
-    if nverts == []:
+    if len(nverts) == 0:
         debug("error empty poly mesh %s" % ob.name)
-        removeMeshFromMemory(mesh.name)
+        if data is None:
+            removeMeshFromMemory(mesh.name)
         return
     primvars = get_primvars(ob, mesh, "facevarying")
     primvars['P'] = P
     primvars['facevarying normal N'] = N
     if not is_multi_material(mesh):
-        ri.PointsPolygons(nverts, verts, primvars)
+        ri.PointsPolygons(rib(nverts), rib(verts), rib_primvars(primvars))
     else:
         for mat_id, (nverts, verts, primvars) in \
                 split_multi_mesh(nverts, verts, primvars).items():
             # if this is a multi_material mesh output materials
             export_material_archive(ri, mesh.materials[mat_id])
-            ri.PointsPolygons(nverts, verts, primvars)
-    removeMeshFromMemory(mesh.name)
+            ri.PointsPolygons(rib(nverts), rib(verts),
+                              rib_primvars(primvars))
+    if data is None:
+        removeMeshFromMemory(mesh.name)
 
 
 def removeMeshFromMemory(passedName):
@@ -1609,14 +1916,7 @@ def export_particle_system(ri, scene, rpass, ob, psys, objectCorrectionMatrix=Fa
         ri.Basis("CatmullRomBasis", 1, "CatmullRomBasis", 1)
         ri.Attribute("dice", {"int roundcurve": int(
             psys.settings.renderman.round_hair), "int hair": 1})
-        if data is not None and len(data) > 0:
-            export_motion_begin(ri, data)
-            for subframe, sample in data:
-                export_hair(ri, scene, ob, psys, sample,
-                            objectCorrectionMatrix)
-            ri.MotionEnd()
-        else:
-            export_hair(ri, scene, ob, psys, None, objectCorrectionMatrix)
+        export_hair(ri, scene, ob, psys, data, objectCorrectionMatrix)
 
 # many thanks to @rendermouse for this code
 
@@ -1630,69 +1930,62 @@ def export_blobby_family(ri, scene, ob):
     family = data_name(ob, scene)
     master = bpy.data.objects[family]
 
-    fam_blobs = []
-
+    # Because all meta elements are stored in a single collection,
+    # these elements have a link to their parent MetaBall, but NOT the actual tree parent object.
+    # So we go find the parent that owns each metaball.  We need the tree parent in order
+    # to get any world transforms that alter position of the metaball.
+    tforms = []
     for mball in bpy.data.metaballs:
-        fam_blobs.extend([el for el in mball.elements if get_mball_parent(
-            el.id_data).name.split('.')[0] == family])
-
-    # transform
-    tform = []
-
-    # opcodes
-    op = []
-    count = len(fam_blobs)
-    for i in range(count):
-        op.append(1001)  # only blobby ellipsoids for now...
-        op.append(i * 16)
-
-    for meta_el in fam_blobs:
-
-        # Because all meta elements are stored in a single collection,
-        # these elements have a link to their parent MetaBall, but NOT the actual tree parent object.
-        # So I have to go find the parent that owns it.  We need the tree parent in order
-        # to get any world transforms that alter position of the metaball.
-        parent = get_mball_parent(meta_el.id_data)
+        parent = get_mball_parent(mball)
+        if parent is None or len(mball.elements) == 0 or \
+                parent.name.split('.')[0] != family:
+            continue
+        tforms.append(get_mball_transforms(mball, parent))
 
-        m = {}
-        loc = meta_el.co
+    tform = np.concatenate(tforms) if tforms else np.empty(0)
+    count = len(tform)
 
-        # mballs that are only linked to the master by name have their own position,
-        # and have to be transformed relative to the master
-        ploc, prot, psc = parent.matrix_world.decompose()
+    st = ('',)
+    parm = {}
 
-        m = Matrix.Translation(loc)
+    ri.Blobby(count, get_blobby_ops(count), rib(tform.reshape(-1)), st, parm)
 
-        sc = Matrix(((meta_el.radius, 0, 0, 0),
-                     (0, meta_el.radius, 0, 0),
-                     (0, 0, meta_el.radius, 0),
-                     (0, 0, 0, 1)))
 
-        ro = prot.to_matrix().to_4x4()
+# the world transform of every element of a metaball, as rows of 16 floats
+# in rib order
+def get_mball_transforms(mball, parent):
+    elements = mball.elements
+    loc = np.empty(len(elements) * 3, dtype=np.float32)
+    elements.foreach_get('co', loc)
+    radius = np.empty(len(elements), dtype=np.float32)
+    elements.foreach_get('radius', radius)
 
-        m2 = m * sc * ro
-        tform = tform + rib(parent.matrix_world * m2)
+    # mballs that are only linked to the master by name have their own position,
+    # and have to be transformed relative to the master
+    ploc, prot, psc = parent.matrix_world.decompose()
+    ro = np.array(prot.to_matrix(), dtype=np.float32)
 
-    op.append(0)  # blob operation:add
-    op.append(count)
-    for n in range(count):
-        op.append(n)
+    # translate * scale * rotate
+    m2 = np.zeros((len(elements), 4, 4), dtype=np.float32)
+    m2[:, :3, :3] = radius.reshape(-1, 1, 1) * ro
+    m2[:, :3, 3] = loc.reshape(-1, 3)
+    m2[:, 3, 3] = 1.0
+    mtx = np.matmul(np.array(parent.matrix_world, dtype=np.float32), m2)
+    return mtx.transpose(0, 2, 1).reshape(-1, 16)
 
-    st = ('',)
-    parm = {}
 
-    ri.Blobby(count, op, tform, st, parm)
+def get_mball_parent(mball):
+    owners = get_data_owners(mball)
+    return owners[0] if owners else None
 
 
-def get_mball_parent(mball):
-    for ob in bpy.data.objects:
-        if ob.data == mball:
-            return ob
+def get_primitive(ob):
+    return ob.renderman.primitive if ob.renderman.primitive != 'AUTO' \
+        else detect_primitive(ob)
 
 
 def export_geometry_data(ri, scene, ob, data=None):
-    prim = ob.renderman.primitive if ob.renderman.primitive != 'AUTO' \
-        else detect_primitive(ob)
+    prim = get_primitive(ob)
 
     # unsupported type
     if prim == 'NONE':
@@ -1745,15 +2038,46 @@ def is_transforming(ob, do_mb, recurse=False):
     return transforming
 
 
+# every Instance and DataBlock made for the current export, by record type,
+# so the memory they take can be followed as scenes grow
+class RecordRegistry:
+
+    def __init__(self):
+        self.records = {}
+
+    def clear(self):
+        self.records.clear()
+
+    def add(self, record):
+        records = self.records.setdefault(type(record).__name__,
+                                          weakref.WeakSet())
+        records.add(record)
+
+    # count and approximate bytes of the records of each type, with the
+    # lists and strings they hold but not the blender data they point to
+    def summary(self):
+        return dict((name, (len(records),
+                            sum(get_record_size(r) for r in records)))
+                    for name, records in self.records.items())
+
+
+def get_record_size(record):
+    size = sys.getsizeof(record)
+    for slot in record.__slots__:
+        value = getattr(record, slot, None)
+        if isinstance(value, (list, str)):
+            size += sys.getsizeof(value)
+    return size
+
+
+record_registry = RecordRegistry()
+
+
 # Instance holds all the data needed for making an instance of data_block
 class Instance:
-    name = ''
-    type = ''
-    transforming = False
-    motion_data = []
-    archive_filename = ''
-    ob = None
-    material = None
+    __slots__ = ('name', 'type', 'transforming', 'motion_data',
+                 'archive_filename', 'ob', 'material', 'children',
+                 'data_block_names', 'parent', '__weakref__')
 
     def __init__(self, name, type, ob=None,
                  transforming=False):
@@ -1762,27 +2086,23 @@ class Instance:
         self.transforming = transforming
         self.ob = ob
         self.motion_data = []
+        self.archive_filename = ''
+        self.material = None
         self.children = []
         self.data_block_names = []
         self.parent = None
         if hasattr(ob, 'parent') and ob.parent:
             self.parent = ob.parent.name
-        if hasattr(ob, 'children') and ob.children:
-            for child in ob.children:
-                self.children.append(child.name)
+        if isinstance(ob, bpy.types.Object):
+            self.children = [child.name for child in get_object_children(ob)]
+        record_registry.add(self)
 
 
 # Data block holds the info for exporting the archive of a data_block
 class DataBlock:
-    motion_data = []
-    archive_filename = ''
-    deforming = False
-    type = ''
-    data = None
-    name = ''
-    material = []
-    do_export = False
-    dupli_data = False
+    __slots__ = ('name', 'type', 'archive_filename', 'deforming', 'data',
+                 'motion_data', 'material', 'do_export', 'dupli_data',
+                 'cache_key', 'export_time', '__weakref__')
 
     def __init__(self, name, type, archive_filename, data, deforming=False, material=[], do_export=True, dupli_data=False):
         self.name = name
@@ -1794,6 +2114,9 @@ class DataBlock:
         self.material = material
         self.do_export = do_export
         self.dupli_data = dupli_data
+        self.cache_key = ''
+        self.export_time = 0.0
+        record_registry.add(self)
 
 
 def has_emissive_material(db):
@@ -1926,8 +2249,7 @@ def get_dupli_block(ob, rpass, do_mb):
                 dbs.extend(sub_dbs)
         archive_filename = get_archive_filename(name, rpass, deforming)
         dbs.append(DataBlock(name, "DUPLI", archive_filename, ob, deforming=deforming,
-                             dupli_data=True,
-                             do_export=file_is_dirty(rpass.scene, ob, archive_filename)))
+                             dupli_data=True))
         return dbs
 
     else:
@@ -1938,8 +2260,6 @@ def get_dupli_block(ob, rpass, do_mb):
 
         return [DataBlock(name, "MESH", archive_filename, ob,
                           deforming, material=get_used_materials(ob),
-                          do_export=file_is_dirty(
-                              rpass.scene, ob, archive_filename),
                           dupli_data=True)]
 
 
@@ -1981,8 +2301,7 @@ def get_data_blocks_needed(ob, rpass, do_mb):
             mat = [ob.material_slots[psys.settings.material -
                                      1].material] if psys.settings.material and psys.settings.material <= len(ob.material_slots) else []
             data_blocks.append(DataBlock(name, type, archive_filename, data,
-                                         is_psys_animating(ob, psys, do_mb), material=mat,
-                                         do_export=file_is_dirty(rpass.scene, ob, archive_filename)))
+                                         is_psys_animating(ob, psys, do_mb), material=mat))
 
     if hasattr(ob, 'dupli_type') and ob.dupli_type in SUPPORTED_DUPLI_TYPES and not dupli_emitted:
         name = ob.name + '-DUPLI'
@@ -1995,8 +2314,7 @@ def get_data_blocks_needed(ob, rpass, do_mb):
                     dupli_deforming = any(db.deforming for db in sub_dbs)
                 data_blocks.extend(sub_dbs)
         archive_filename = get_archive_filename(name, rpass, dupli_deforming)
-        data_blocks.append(DataBlock(name, "DUPLI", archive_filename, ob, dupli_deforming,
-                                     do_export=file_is_dirty(rpass.scene, ob, archive_filename)))
+        data_blocks.append(DataBlock(name, "DUPLI", archive_filename, ob, dupli_deforming))
 
     # now the objects data
     if is_data_renderable(rpass.scene, ob) and emit_ob:
@@ -2017,8 +2335,7 @@ def get_data_blocks_needed(ob, rpass, do_mb):
                                                     rpass, deforming)
             data_blocks.append(DataBlock(name, "MESH", archive_filename, ob,
                                          deforming, material=get_used_materials(
-                                             ob),
-                                         do_export=file_is_dirty(rpass.scene, ob, archive_filename)))
+                                             ob)))
 
     return data_blocks
 
@@ -2030,12 +2347,369 @@ def relpath_archive(archive_filename, rpass):
         return os.path.relpath(archive_filename, rpass.paths['archive'])
 
 
-def file_is_dirty(scene, ob, archive_filename):
-    if scene.renderman.lazy_rib_gen:
-        return check_if_archive_dirty(ob.renderman.update_timestamp,
-                                      archive_filename)
+# ------------- Archive Cache -------------
+# With lazy_rib_gen on, an archive is only written again when the hash of
+# what goes into it changes.  The hashes are kept in an index file next to
+# the static archives, so unchanged data blocks are skipped across sessions.
+ARCHIVE_CACHE_VERSION = 1
+
+
+def archive_cache_path(rpass):
+    return os.path.join(rpass.paths['archive'], 'archive_cache.json')
+
+
+def load_archive_cache(rpass):
+    try:
+        with open(archive_cache_path(rpass)) as f:
+            cache = json.load(f)
+        if cache.get('version') == ARCHIVE_CACHE_VERSION:
+            return cache['archives']
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return {}
+
+
+# frame workers save the cache at the same time.  a lock file is held
+# while the cache is read, changed and replaced, and the changes are
+# applied to the cache as it is on disk now, not as it was loaded, to keep
+# what other processes added
+ARCHIVE_CACHE_LOCK_TIMEOUT = 30.0
+ARCHIVE_CACHE_LOCK_STALE = 120.0
+
+
+def lock_archive_cache(lock_path):
+    start = time.time()
+    while True:
+        try:
+            os.close(os.open(lock_path,
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            pass
+        # a process that died while saving leaves its lock behind
+        try:
+            if time.time() - os.path.getmtime(lock_path) > \
+                    ARCHIVE_CACHE_LOCK_STALE:
+                os.remove(lock_path)
+                continue
+        except OSError:
+            continue
+        if time.time() - start > ARCHIVE_CACHE_LOCK_TIMEOUT:
+            return False
+        time.sleep(0.05)
+
+
+def save_archive_cache(rpass, changes):
+    path = archive_cache_path(rpass)
+    lock_path = path + '.lock'
+    try:
+        if not lock_archive_cache(lock_path):
+            # the archives are written, they just aren't skipped next time
+            debug('warning', 'Could not lock the archive cache', path)
+            return
+    except OSError:
+        debug('warning', 'Could not lock the archive cache', path)
+        return
+    temp_path = None
+    try:
+        archive_cache = load_archive_cache(rpass)
+        for key, cache_key in changes.items():
+            if cache_key:
+                archive_cache[key] = cache_key
+            else:
+                archive_cache.pop(key, None)
+        fd, temp_path = tempfile.mkstemp(prefix='archive_cache.',
+                                         suffix='.tmp',
+                                         dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': ARCHIVE_CACHE_VERSION,
+                       'archives': archive_cache}, f, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
+    except OSError:
+        debug('warning', 'Could not write the archive cache', path)
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+
+def rna_value(value):
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if isinstance(value, set):
+        return sorted(value)
+    try:
+        return [rna_value(v) for v in value]
+    except TypeError:
+        return str(value)
+
+
+# hash the settings of an rna struct, and of the property groups in its
+# collections.  pointers are skipped, their data is hashed on its own
+def hash_rna(h, ptr, depth=0):
+    for prop in ptr.bl_rna.properties:
+        key = prop.identifier
+        if key == 'rna_type' or prop.type == 'POINTER':
+            continue
+        if prop.type == 'COLLECTION':
+            if depth < 2:
+                for item in getattr(ptr, key):
+                    hash_rna(h, item, depth + 1)
+            continue
+        try:
+            value = getattr(ptr, key)
+        except AttributeError:
+            continue
+        h.update(repr((key, rna_value(value))).encode())
+
+
+def hash_array(h, array):
+    h.update(repr((array.dtype.str, array.shape)).encode())
+    h.update(np.ascontiguousarray(array).tobytes())
+
+
+def hash_foreach(h, collection, attr, dtype, size=1):
+    buf = np.empty(len(collection) * size, dtype=dtype)
+    collection.foreach_get(attr, buf)
+    hash_array(h, buf)
+
+
+def hash_mesh(h, ob, mesh):
+    hash_foreach(h, mesh.vertices, 'co', np.float32, 3)
+    hash_foreach(h, mesh.loops, 'vertex_index', np.int32)
+    hash_foreach(h, mesh.polygons, 'loop_total', np.int32)
+    hash_foreach(h, mesh.polygons, 'material_index', np.int32)
+    hash_foreach(h, mesh.polygons, 'use_smooth', bool)
+    hash_foreach(h, mesh.edges, 'crease', np.float32)
+    for layer in mesh.uv_layers:
+        h.update(layer.name.encode())
+        hash_foreach(h, layer.data, 'uv', np.float32, 2)
+    for layer in mesh.vertex_colors:
+        h.update(layer.name.encode())
+        if len(layer.data):
+            hash_foreach(h, layer.data, 'color', np.float32,
+                         len(layer.data[0].color))
+    if ob.type == 'MESH' and any(p.data_source == 'VERTEX_GROUP'
+                                 for p in ob.data.renderman.prim_vars):
+        weights = get_mesh_vgroups(mesh, ob.vertex_groups)
+        for index in sorted(weights):
+            hash_array(h, weights[index])
+
+
+def hash_curve(h, curve):
+    for spline in curve.splines:
+        h.update(repr(spline.use_cyclic_u).encode())
+        for attr, size in (('handle_left', 3), ('co', 3),
+                           ('handle_right', 3), ('radius', 1)):
+            hash_foreach(h, spline.bezier_points, attr, np.float32, size)
+
+
+def hash_particles(h, scene, psys):
+    particles = psys.particles
+    for attr, size in (('location', 3), ('rotation', 4), ('size', 1),
+                       ('velocity', 3), ('angular_velocity', 3),
+                       ('birth_time', 1), ('die_time', 1), ('lifetime', 1)):
+        hash_foreach(h, particles, attr, np.float32, size)
+    hash_array(h, get_particles_alive(particles))
+    # age is relative to the current frame
+    h.update(repr(scene.frame_current).encode())
+
+
+# the strands are hashed as they are exported, so an emitter posed by an
+# armature or shape keys, or hair dynamics, change the key too
+def hash_hair(h, scene, ob, psys):
+    h.update(repr(rib(ob.matrix_world)).encode())
+    for curve_set in iter_strands(scene, ob, psys):
+        hash_motion_sample(h, curve_set)
+
+
+def hash_motion_sample(h, sample):
+    if isinstance(sample, (list, tuple, HairSample)):
+        for item in sample:
+            hash_motion_sample(h, item)
+    elif isinstance(sample, MeshSample):
+        hash_motion_sample(h, (sample.P, sample.N, sample.topology))
+    elif isinstance(sample, np.ndarray):
+        hash_array(h, sample)
     else:
-        return True
+        h.update(repr(sample).encode())
+
+
+def hash_dupli(h, scene, ob):
+    ob.dupli_list_create(scene, "RENDER")
+    for dupob in ob.dupli_list:
+        mat = dupob.object.active_material
+        h.update(repr((dupob.object.name, dupob.index,
+                       dupob.object.data.name if dupob.object.data else '',
+                       mat.name if mat else '',
+                       rib(dupob.matrix))).encode())
+    ob.dupli_list_clear()
+    h.update(repr(rib(ob.matrix_world)).encode())
+
+
+# hash everything that ends up in the archive of a data block,
+# or return None if it can't be cached
+def get_archive_cache_key(scene, db):
+    h = hashlib.sha1()
+    h.update(repr((addon_version, db.name, db.type, db.deforming,
+                   [mat.name if mat else '' for mat in db.material])).encode())
+
+    if db.type == 'MESH':
+        ob = db.data
+        prim = detect_primitive(ob)
+        # blobby families, volumes and points depend on more than this object
+        if prim in ('META', 'SMOKE', 'RI_VOLUME', 'POINTS', 'NONE'):
+            return None
+        hash_rna(h, ob.renderman)
+        if ob.data and hasattr(ob.data, 'renderman'):
+            hash_rna(h, ob.data.renderman)
+        for mod in ob.modifiers:
+            h.update(mod.type.encode())
+            hash_rna(h, mod)
+
+        if prim == 'CURVE' and ob.data.extrude + ob.data.bevel_depth == 0:
+            hash_curve(h, ob.data)
+        elif prim in ('POLYGON_MESH', 'SUBDIVISION_MESH', 'CURVE', 'FONT'):
+            mesh = create_mesh(ob, scene)
+            hash_mesh(h, ob, mesh)
+            removeMeshFromMemory(mesh.name)
+        # motion samples only hold the deformed points and normals
+        for subframe, sample in db.motion_data or []:
+            h.update(repr(subframe).encode())
+            hash_motion_sample(h, sample)
+
+    elif db.type == 'PSYS':
+        ob, psys = db.data
+        hash_rna(h, psys)
+        hash_rna(h, psys.settings)
+        hash_rna(h, psys.settings.renderman)
+        hash_rna(h, psys.settings.cycles)
+        for mod in ob.modifiers:
+            h.update(mod.type.encode())
+            hash_rna(h, mod)
+
+        if db.motion_data:
+            for subframe, sample in db.motion_data:
+                h.update(repr(subframe).encode())
+                hash_motion_sample(h, sample)
+        elif psys.settings.type == 'EMITTER':
+            hash_particles(h, scene, psys)
+        else:
+            hash_hair(h, scene, ob, psys)
+
+    elif db.type == 'DUPLI':
+        hash_dupli(h, scene, db.data)
+
+    return h.hexdigest()
+
+
+# free the motion samples of a data block that won't be exported
+def free_motion_data(db):
+    for subframe, sample in db.motion_data or []:
+        if isinstance(sample, HairSample):
+            sample.free()
+    db.motion_data = []
+
+
+def free_data_blocks(data_blocks):
+    for db in data_blocks.values():
+        free_motion_data(db)
+
+
+# skip the data blocks whose archive is up to date
+def check_archive_cache(scene, rpass, data_blocks, archive_cache):
+    for db in data_blocks.values():
+        if not db.do_export:
+            continue
+        try:
+            db.cache_key = get_archive_cache_key(scene, db) or ''
+        except Exception:
+            debug('warning', 'Could not hash %s for the archive cache' %
+                  db.name, traceback.format_exc())
+            db.cache_key = ''
+        if db.cache_key and os.path.exists(db.archive_filename) and \
+                archive_cache.get(relpath_archive(db.archive_filename, rpass)) \
+                == db.cache_key:
+            db.do_export = False
+            free_motion_data(db)
+
+
+def update_archive_cache(rpass, archive_cache, exported_blocks):
+    changes = {}
+    for db in exported_blocks:
+        key = relpath_archive(db.archive_filename, rpass)
+        changes[key] = db.cache_key
+        if db.cache_key:
+            archive_cache[key] = db.cache_key
+        else:
+            archive_cache.pop(key, None)
+    save_archive_cache(rpass, changes)
+
+
+# ------------- Static Archive Reuse -------------
+
+# When a frame range is exported in one go the archives of data blocks that
+# don't deform are the same file for every frame, so they only need writing
+# for the first frame that has them.  The rest of the range reuses them.
+# With a claim_dir the range is shared with other processes, and only the
+# process that claims an archive first writes it.
+class StaticArchiveReuse:
+
+    def __init__(self, claim_dir=None):
+        self.claim_dir = claim_dir
+        # archive filename -> seconds spent exporting it
+        self.written = {}
+        self.archives_reused = 0
+        self.bytes_saved = 0
+        self.seconds_saved = 0.0
+
+    def skip_written(self, data_blocks):
+        for db in data_blocks.values():
+            if not db.do_export or db.deforming:
+                continue
+            if db.archive_filename not in self.written:
+                if self.claim(db.archive_filename):
+                    continue
+                # another process writes this one
+                self.written[db.archive_filename] = 0.0
+            db.do_export = False
+            free_motion_data(db)
+            self.archives_reused += 1
+            self.seconds_saved += self.written[db.archive_filename]
+            try:
+                self.bytes_saved += os.path.getsize(db.archive_filename)
+            except OSError:
+                pass
+
+    def claim(self, archive_filename):
+        if self.claim_dir is None:
+            return True
+        name = hashlib.md5(archive_filename.encode('utf-8')).hexdigest()
+        try:
+            os.close(os.open(os.path.join(self.claim_dir, name),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            return False
+
+    def add_written(self, data_blocks, exported_blocks):
+        exported = set(db.archive_filename for db in exported_blocks)
+        for db in data_blocks.values():
+            if db.deforming or db.archive_filename in self.written:
+                continue
+            if db.archive_filename in exported:
+                self.written[db.archive_filename] = db.export_time
+            elif db.cache_key and not db.do_export:
+                # found up to date in the archive cache
+                self.written[db.archive_filename] = 0.0
+
+    def summary(self):
+        return 'reused %d static archives, saved %.2f MB and %.2f seconds' % \
+            (self.archives_reused, self.bytes_saved / (1024.0 * 1024.0),
+             self.seconds_saved)
 
 
 def get_transform(instance, subframe):
@@ -2055,8 +2729,13 @@ def get_deformation(data_block, subframe, scene, subframes):
         return
     else:
         if data_block.type == "MESH":
-            mesh = create_mesh(data_block.data, scene)
-            data_block.motion_data.append((subframe, mesh))
+            ob = data_block.data
+            mesh = create_mesh(ob, scene)
+            # only polygon meshes export normals
+            sample = MeshSample(mesh, get_normals=get_primitive(ob) !=
+                                'SUBDIVISION_MESH')
+            removeMeshFromMemory(mesh.name)
+            data_block.motion_data.append((subframe, sample))
         elif data_block.type == "PSYS":
             ob, psys = data_block.data
             if psys.settings.type == "EMITTER":
@@ -2067,9 +2746,31 @@ def get_deformation(data_block, subframe, scene, subframes):
                 data_block.motion_data.append((subframe, points))
             else:
                 # this is hair
-                hairs = get_strands(scene, ob, psys)
+                hairs = HairSample(iter_strands(scene, ob, psys))
                 data_block.motion_data.append((subframe, hairs))
 
+# Merge the subframes of all the motion segment groups into one schedule,
+# sorted from past to present so the motion samples are gathered in order.
+# Subframes shared by several groups are evaluated once, the second value
+# returned is the number of scene evaluations this saves.
+def get_motion_schedule(scene, motion_segs):
+    origframe = scene.frame_current
+    schedule = {}
+    num_evaluations = 0
+    for num_segs, (instance_names, data_names) in motion_segs.items():
+        subframes = get_subframes(num_segs, scene)
+        actual_subframes = [origframe + subframe for subframe in subframes]
+        num_evaluations += len(subframes)
+        for seg in subframes:
+            # group subframes that only differ by float error
+            key = round(seg, 6)
+            schedule.setdefault(key, (seg, []))[1].append(
+                (seg, instance_names, data_names, actual_subframes))
+
+    schedule = [schedule[key] for key in sorted(schedule)]
+    return schedule, num_evaluations - len(schedule)
+
+
 # Create two lists, one of data blocks to export and one of instances to export
 # Collect and store motion blur transformation data in a pre-process.
 # More efficient, and avoids too many frame updates in blender.
@@ -2079,26 +2780,30 @@ def cache_motion(scene, rpass, objects=None):
     if objects is None:
         objects = scene.objects
     origframe = scene.frame_current
+    index_objects()
+    record_registry.clear()
     instances, data_blocks, motion_segs = \
         get_instances_and_blocks(objects, rpass)
+    for name, (count, size) in sorted(record_registry.summary().items()):
+        debug('info', '%s records: %d, about %d KB' %
+              (name, count, size // 1024))
 
     # the aim here is to do only a minimal number of scene updates,
-    # so we process objects in batches of equal numbers of segments
-    # and update the scene only once for each of those unique fractional
-    # frames per segment set
-    for num_segs, (instance_names, data_names) in motion_segs.items():
-        # prepare list of frames/sub-frames in advance,
-        # ordered from future to present,
-        # to prevent too many scene updates
-        # (since loop ends on current frame/subframe)
-        subframes = get_subframes(num_segs, scene)
-        actual_subframes = [origframe + subframe for subframe in subframes]
-        for seg in subframes:
-            if seg < 0.0:
-                scene.frame_set(origframe - 1, 1.0 + seg)
-            else:
-                scene.frame_set(origframe, seg)
+    # so every distinct subframe of all the segment sets is set once
+    # and handed to all the objects sampled there
+    schedule, rpass.motion_evaluations_saved = \
+        get_motion_schedule(scene, motion_segs)
+    if rpass.motion_evaluations_saved:
+        debug('info', 'motion blur: %d scene evaluations saved' %
+              rpass.motion_evaluations_saved)
+
+    for frame_seg, samples in schedule:
+        if frame_seg < 0.0:
+            scene.frame_set(origframe - 1, 1.0 + frame_seg)
+        else:
+            scene.frame_set(origframe, frame_seg)
 
+        for seg, instance_names, data_names, actual_subframes in samples:
             for name in instance_names:
                 get_transform(instances[name], seg)
 
@@ -2120,29 +2825,121 @@ def get_valid_empties(scene, rpass):
     return empties
 
 
+def report_archive_error(engine, archive_filename, error):
+    if engine:
+        engine.report({'ERROR'}, 'Rib gen error exporting %s: ' %
+                      archive_filename + error)
+    else:
+        print('ERROR: Rib gen error exporting %s:' % archive_filename, error)
+
+
+def get_rib_options(rm):
+    rib_options = {"string format": "binary"} if rm.rib_format == "binary" else {
+        "string format": "ascii", "string asciistyle": "indented,wide"}
+    if rm.rib_compression == "gzip":
+        rib_options["string compression"] = "gzip"
+    return rib_options
+
+
+def export_data_archive(ri, scene, rpass, db, data_blocks):
+    if db.type == "MESH":
+        export_mesh_archive(ri, scene, db)
+    elif db.type == "PSYS":
+        export_particle_archive(ri, scene, rpass, db)
+    elif db.type == "DUPLI":
+        export_dupli_archive(ri, scene, rpass, db, data_blocks)
+
+
+# start worker processes for writing archives, or None if they can't be
+def start_rib_writer_pool(scene, num_jobs):
+    num_workers = scene.renderman.archive_export_processes
+    if num_workers <= 0:
+        num_workers = max(1, (os.cpu_count() or 1) + num_workers)
+    num_workers = min(num_workers, num_jobs)
+    if num_workers < 2:
+        return None
+
+    # the workers need the same python blender runs, with prman importable
+    python_exe = getattr(bpy.app, 'binary_path_python', '') or sys.executable
+    rmantree = guess_rmantree()
+    env = os.environ.copy()
+    env['RMANTREE'] = rmantree
+    python_path = [os.path.join(rmantree, 'bin')]
+    if env.get('PYTHONPATH'):
+        python_path.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(python_path)
+
+    try:
+        return RibWriterPool(num_workers, python_exe, env)
+    except OSError:
+        debug('warning', 'Could not start archive writer processes, '
+              'exporting archives serially', traceback.format_exc())
+        return None
+
+
 # export data_blocks
-def export_data_archives(ri, scene, rpass, data_blocks, engine):
-    for name, db in data_blocks.items():
-        if not db.do_export:
-            continue
+def export_data_archives(ri, scene, rpass, data_blocks, engine,
+                         archive_cache=None):
+    dirty_blocks = [db for db in data_blocks.values() if db.do_export]
+    exported_blocks = []
+    pool = None
+    if scene.renderman.parallel_archive_export and len(dirty_blocks) > 1:
+        pool = start_rib_writer_pool(scene, len(dirty_blocks))
+
+    if pool is None:
+        for db in dirty_blocks:
+            start = time.time()
+            try:
+                ri.Begin(db.archive_filename)
+                debug('info', db.archive_filename)
+                export_data_archive(ri, scene, rpass, db, data_blocks)
+                ri.End()
+                exported_blocks.append(db)
+            except Exception as err:
+                ri.End()
+                report_archive_error(engine, db.archive_filename,
+                                     traceback.format_exc())
+            db.export_time = time.time() - start
+        if archive_cache is not None:
+            update_archive_cache(rpass, archive_cache, exported_blocks)
+        return exported_blocks
+
+    # blender data is read here on the main thread, the workers do the
+    # writing while we move on to the next data block
+    rib_options = get_rib_options(scene.renderman)
+    recorded_blocks = {}
+    for db in dirty_blocks:
+        debug('info', db.archive_filename)
+        recorder = RibRecorder(ri)
+        start = time.time()
         try:
-            ri.Begin(db.archive_filename)
-            debug('info', db.archive_filename)
-            if db.type == "MESH":
-                export_mesh_archive(ri, scene, db)
-            elif db.type == "PSYS":
-                export_particle_archive(ri, scene, rpass, db)
-            elif db.type == "DUPLI":
-                export_dupli_archive(ri, scene, rpass, db, data_blocks)
-            ri.End()
+            export_data_archive(recorder, scene, rpass, db, data_blocks)
+            recorded_blocks[db.archive_filename] = db
         except Exception as err:
-            ri.End()
-            if engine:
-                engine.report({'ERROR'}, 'Rib gen error exporting %s: ' %
-                              db.archive_filename + traceback.format_exc())
-            else:
-                print('ERROR: Rib gen error exporting %s:' %
-                      db.archive_filename, traceback.format_exc())
+            # a partial recording would be written as a truncated archive
+            report_archive_error(engine, db.archive_filename,
+                                 traceback.format_exc())
+            continue
+        finally:
+            db.export_time = time.time() - start
+        pool.submit(db.archive_filename, rib_options, recorder.calls)
+
+    for archive_filename, error, job in pool.join():
+        if job is not None:
+            # no worker could take this one, write it here.  the rib
+            # options are already set on this ri
+            try:
+                write_archive(ri, archive_filename, None, job[2])
+            except Exception as err:
+                error = traceback.format_exc()
+        if error:
+            report_archive_error(engine, archive_filename, error)
+        elif archive_filename in recorded_blocks:
+            exported_blocks.append(recorded_blocks[archive_filename])
+
+    if archive_cache is not None:
+        update_archive_cache(rpass, archive_cache, exported_blocks)
+    return exported_blocks
 
 # Deal with the special needs of a RIB archive but after that pass on to
 # the same functions that export_data_archives does.
@@ -2170,12 +2967,32 @@ def export_RIBArchive_data_archive(ri, scene, rpass, data_blocks, exportMaterial
             export_dupli_archive(ri, scene, rpass, db, data_blocks)
 
 
-# export each data read archive
+# export each data read archive, and those of the children of the instance.
+# the hierarchy is walked with a stack, deep parenting chains would run into
+# the recursion limit otherwise
 def export_instance_read_archive(ri, instance, instances, data_blocks, rpass, is_child=False, visible_objects=None):
+    stack = [(instance, is_child, False)]
+    while stack:
+        instance, is_child, children_done = stack.pop()
+        if children_done:
+            export_instance_end(ri, instance)
+            continue
+
+        export_instance_begin(ri, instance, data_blocks, rpass, is_child,
+                              visible_objects)
+        stack.append((instance, is_child, True))
+        # now the children
+        for child_name in reversed(instance.children):
+            if child_name in instances:
+                stack.append((instances[child_name], True, False))
+
+
+def export_instance_begin(ri, instance, data_blocks, rpass, is_child, visible_objects):
     ri.AttributeBegin()
     ri.Attribute("identifier", {"string name": instance.name})
     if instance.ob:
-        export_object_attributes(ri, rpass.scene, instance.ob, visible_objects)
+        export_object_attributes(ri, rpass.scene, instance.ob, visible_objects,
+                                 rpass.linking_index)
     # now the matrix, if we're transforming do the motion here
     if instance.type != 'META':
         export_transform(ri, instance, concat=is_child)
@@ -2198,12 +3015,8 @@ def export_instance_read_archive(ri, instance, instances, data_blocks, rpass, is
             else:
                 export_data_read_archive(ri, data_blocks[db_name], rpass, skip_material=object_material)
 
-        # now the children
-    for child_name in instance.children:
-        if child_name in instances:
-            export_instance_read_archive(
-                ri, instances[child_name], instances, data_blocks, rpass, is_child=True, visible_objects=visible_objects)
 
+def export_instance_end(ri, instance):
     if instance.ob and instance.ob.renderman.post_object_rib_box != '':
         export_rib_box(ri, instance.ob.renderman.post_object_rib_box)
 
@@ -2326,7 +3139,72 @@ def export_rib_box(ri, text_name):
 
 
 # here we would export object attributes like holdout, sr, etc
-def export_object_attributes(ri, scene, ob, visible_objects):
+# the object groups of each object and the resolved calls of each light
+# link, built once per export so export_object_attributes doesn't have to
+# scan all the groups, links and lights for every object
+class LinkingIndex:
+
+    def __init__(self, scene):
+        rm = scene.renderman
+        self.groups = {}
+        for group in rm.object_groups:
+            for ob_name in group.members.keys():
+                self.groups.setdefault(ob_name, []).append(group.name)
+
+        scene_lights = [l.name for l in scene.objects if l.type == 'LAMP']
+        # the lights each filter is used by
+        filter_lights = {}
+        for light_name in scene_lights:
+            lamp = scene.objects[light_name].data
+            for filter_name in lamp.renderman.light_filters.keys():
+                filter_lights.setdefault(filter_name, []).append(light_name)
+
+        # the (light, filter, on) of the links of each object or group, the
+        # filter is None for links that just illuminate
+        self.links = {}
+        for link in rm.ll:
+            strs = link.name.split('>')
+            if len(strs) != 4:
+                continue
+            calls = self.links.setdefault((strs[2], strs[3]), [])
+            if link.illuminate == "DEFAULT":
+                continue
+
+            if strs[0] == "lg_light":
+                light_names = [strs[1]]
+            elif strs[0] == 'lg_group' and strs[1] == 'All':
+                light_names = scene_lights
+            else:
+                # links to light groups that were removed are skipped
+                light_group = rm.light_groups.get(strs[1])
+                if light_group is None:
+                    continue
+                light_names = light_group.members.keys()
+            for light_name in light_names:
+                if light_name not in scene.objects:
+                    continue
+                lamp = scene.objects[light_name].data
+                if lamp.renderman.renderman_type == 'FILTER':
+                    # for each lamp this is a part of do enable light filter
+                    for light_nm in filter_lights.get(light_name, []):
+                        calls.append((light_nm, light_name,
+                                      link.illuminate == 'ON'))
+                else:
+                    calls.append((light_name, None, link.illuminate == 'ON'))
+
+    def get_groups(self, ob):
+        return self.groups.get(ob.name, [])
+
+    # the light links of an object, its own links first then those of
+    # its groups
+    def get_light_links(self, ob):
+        calls = list(self.links.get(("obj_object", ob.name), []))
+        for group_name in self.get_groups(ob):
+            calls.extend(self.links.get(("obj_group", group_name), []))
+        return calls
+
+
+def export_object_attributes(ri, scene, ob, visible_objects, linking=None):
     # save space! don't export default attribute settings to the RIB
     # shading attributes
 
@@ -2339,10 +3217,12 @@ def export_object_attributes(ri, scene, ob, visible_objects):
     if rm.pre_object_rib_box != '':
         export_rib_box(ri, rm.pre_object_rib_box)
 
+    if linking is None:
+        linking = LinkingIndex(scene)
+
     obj_groups_str = "*"
-    for obj_group in scene.renderman.object_groups:
-        if ob.name in obj_group.members.keys():
-            obj_groups_str += ',' + obj_group.name
+    for group_name in linking.get_groups(ob):
+        obj_groups_str += ',' + group_name
     # add to trace sets
     if obj_groups_str != '*':
         ri.Attribute("grouping", {"string membership": obj_groups_str})
@@ -2419,37 +3299,11 @@ def export_object_attributes(ri, scene, ob, visible_objects):
         ri.Attribute("trace", trace_params)
 
     # light linking
-    # get links this is a part of
-    ll_str = "obj_object>%s" % ob.name
-    lls = [ll for ll in scene.renderman.ll if ll_str in ll.name]
-    # get links this is a group that is a part of
-    for group in scene.renderman.object_groups:
-        if ob.name in group.members.keys():
-            ll_str = "obj_group>%s" % group.name
-            lls += [ll for ll in scene.renderman.ll if ll_str in ll.name]
-
-    # for each light link do illuminates
-    for link in lls:
-        strs = link.name.split('>')
-
-        scene_lights = [l.name for l in scene.objects if l.type == 'LAMP']
-        light_names = [strs[1]] if strs[0] == "lg_light" else \
-            scene.renderman.light_groups[strs[1]].members.keys()
-        if strs[0] == 'lg_group' and strs[1] == 'All':
-            light_names = scene_lights
-        for light_name in light_names:
-            if link.illuminate != "DEFAULT" and light_name in scene.objects:
-                light_ob = scene.objects[light_name]
-                lamp = light_ob.data
-                if lamp.renderman.renderman_type == 'FILTER':
-                    # for each lamp this is a part of do enable light filter
-                    filter_name = light_name
-                    for light_nm in scene_lights:
-                        if filter_name in scene.objects[light_nm].data.renderman.light_filters.keys():
-                            ri.EnableLightFilter(
-                                light_nm, filter_name, link.illuminate == 'ON')
-                else:
-                    ri.Illuminate(light_name, link.illuminate == 'ON')
+    for light_name, filter_name, on in linking.get_light_links(ob):
+        if filter_name is not None:
+            ri.EnableLightFilter(light_name, filter_name, on)
+        else:
+            ri.Illuminate(light_name, on)
 
     user_attr = {}
     for i in range(8):
@@ -2478,10 +3332,28 @@ def export_mesh_archive(ri, scene, data_block):
     ob = data_block.data
 
     if motion_data is not None and len(motion_data):
-        export_motion_begin(ri, motion_data)
-        for (subframes, sample) in motion_data:
-            export_geometry_data(ri, scene, ob, data=sample)
-        ri.MotionEnd()
+        # the samples only hold points and normals, the rest is
+        # read from the mesh at the current frame
+        mesh = create_mesh(ob, scene)
+        try:
+            (nverts, verts, P, N) = get_mesh(mesh)
+            topology = get_mesh_topology(nverts, verts)
+            if all(sample.topology == topology
+                   for (subframe, sample) in motion_data):
+                export_motion_begin(ri, motion_data)
+                for (subframe, sample) in motion_data:
+                    sample.mesh = mesh
+                    export_geometry_data(ri, scene, ob, data=sample)
+                export_motion_end(ri, motion_data)
+            else:
+                debug('warning', 'The topology of %s changes while the '
+                      'shutter is open, exporting it without motion blur' %
+                      ob.name)
+                sample = MeshSample(mesh, get_normals=True)
+                sample.mesh = mesh
+                export_geometry_data(ri, scene, ob, data=sample)
+        finally:
+            removeMeshFromMemory(mesh.name)
     else:
         export_geometry_data(ri, scene, ob)
 
@@ -2493,8 +3365,11 @@ def export_mesh_archive(ri, scene, data_block):
 def export_particle_archive(ri, scene, rpass, data_block, objectCorrectionMatrix=False):
     ob, psys = data_block.data
     data = data_block.motion_data if data_block.deforming else None
-    export_particle_system(ri, scene, rpass, ob, psys,
-                           objectCorrectionMatrix, data=data)
+    try:
+        export_particle_system(ri, scene, rpass, ob, psys,
+                               objectCorrectionMatrix, data=data)
+    finally:
+        free_motion_data(data_block)
     data_block.motion_data = None
 
 # export the archives for an mesh. If this is a
@@ -2570,20 +3445,165 @@ def export_dupli_archive(ri, scene, rpass, data_block, data_blocks):
     ob.dupli_list_clear()
 
 
-# export an archive with all the materials and read it back in
-def export_materials_archive(ri, rpass, scene):
+# the materials the data blocks of this export can read, in the order of
+# bpy.data.materials.  all the materials of the objects behind the data
+# blocks are kept, with those of the objects they instance
+def get_export_materials(scene, data_blocks):
+    used = set()
+    seen = set()
+
+    def add_object(ob):
+        if ob is None or ob.as_pointer() in seen:
+            return
+        seen.add(ob.as_pointer())
+        mats = [slot.material for slot in ob.material_slots]
+        if ob.data is not None and hasattr(ob.data, 'materials'):
+            mats.extend(ob.data.materials)
+        used.update(mat.as_pointer() for mat in mats if mat)
+
+        if ob.dupli_type == 'GROUP' and ob.dupli_group:
+            for child in ob.dupli_group.objects:
+                add_object(child)
+        elif ob.dupli_type in SUPPORTED_DUPLI_TYPES:
+            for child in get_object_children(ob):
+                add_object(child)
+        for psys in ob.particle_systems:
+            rm = psys.settings.renderman
+            if rm.particle_instance_object:
+                add_object(bpy.data.objects.get(rm.particle_instance_object))
+
+    for db in data_blocks.values():
+        used.update(mat.as_pointer() for mat in db.material if mat)
+        add_object(db.data[0] if db.type == 'PSYS' else db.data)
+    # rib archives on empties can use the scene materials too
+    for ob in get_valid_empties(scene, None):
+        add_object(ob)
+
+    return [mat for mat in bpy.data.materials if mat.as_pointer() in used]
+
+
+def hash_node_tree(h, nt, seen):
+    seen.add(nt.as_pointer())
+    for node in nt.nodes:
+        h.update(repr((node.name, node.bl_idname)).encode())
+        hash_rna(h, node)
+        # the text of internal OSL and SeExpr code goes into the archive,
+        # not just its name
+        text_name = getattr(node, 'internalSearch', '')
+        if text_name and text_name in bpy.data.texts:
+            h.update(bpy.data.texts[text_name].as_string().encode())
+        if node.bl_idname == 'ShaderNodeGroup' and node.node_tree and \
+                node.node_tree.as_pointer() not in seen:
+            hash_node_tree(h, node.node_tree, seen)
+    for link in nt.links:
+        h.update(repr((link.from_node.name, link.from_socket.identifier,
+                       link.to_node.name, link.to_socket.identifier)).encode())
+
+
+# hash everything that ends up in the archive of a material
+def get_material_archive_key(scene, mat):
+    from . import engine
+    h = hashlib.sha1()
+    h.update(repr((addon_version, mat.name, engine.ipr is not None)).encode())
+    hash_rna(h, mat.renderman)
+    # what export_shader reads for materials without a node tree
+    h.update(repr((rib(mat.diffuse_color), mat.specular_intensity, mat.emit,
+                   mat.subsurface_scattering.use,
+                   mat.subsurface_scattering.scale,
+                   rib(mat.subsurface_scattering.color),
+                   mat.raytrace_mirror.use,
+                   mat.raytrace_mirror.reflect_factor)).encode())
+    if mat.node_tree:
+        hash_node_tree(h, mat.node_tree, set())
+        # the texture file names written, these depend on the texture
+        # output path and the frame for texture sequences
+        h.update(scene.renderman.path_texture_output.encode())
+        for node in mat.node_tree.nodes:
+            for prop, options, skip_tex in get_texture_sources_for_node(node):
+                h.update(get_tex_file_name(prop).encode())
+    return h.hexdigest()
+
+
+# write an archive for every material used by the data blocks, named by the
+# hash of the material so it can be read by every frame and session the
+# material doesn't change in.  with lazy_rib_gen on, archives already written
+# are reused.  returns the material archives to read
+def export_material_archives(ri, rpass, scene, data_blocks):
+    rm = scene.renderman
+    _p_ = user_path(rm.path_object_archive_static, scene)
+    archives = []
+    for mat in get_export_materials(scene, data_blocks):
+        key = get_material_archive_key(scene, mat)
+        archive_filename = _p_.replace(
+            '{object}', 'material.%s.%s' % (get_mat_name(mat.name), key[:16]))
+        if not rm.lazy_rib_gen or not os.path.exists(archive_filename):
+            write_material_archive(ri, mat, archive_filename)
+        archives.append((mat, archive_filename))
+    return archives
+
+
+# written to a temp file first, so an archive that is there is always
+# complete.  frame workers write the same archives at the same time, so
+# every process writes its own temp file.  the content is keyed by hash,
+# so it doesn't matter whose file ends up under the archive name
+def write_material_archive(ri, mat, archive_filename):
+    fd, temp_filename = tempfile.mkstemp(
+        prefix=os.path.basename(archive_filename) + '.', suffix='.tmp',
+        dir=os.path.dirname(archive_filename))
+    os.close(fd)
+    try:
+        ri.Begin(temp_filename)
+        try:
+            export_material(ri, mat)
+        finally:
+            ri.End()
+        os.replace(temp_filename, archive_filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+# remove the material archives that none of the materials in the file
+# would write now.  other sessions and ipr renders may still read older
+# archives, so this is only done when asked for
+def clean_material_archives(scene):
+    _p_ = user_path(scene.renderman.path_object_archive_static, scene)
+    current = set()
+    for mat in bpy.data.materials:
+        key = get_material_archive_key(scene, mat)
+        current.add(os.path.abspath(_p_.replace(
+            '{object}', 'material.%s.%s' % (get_mat_name(mat.name),
+                                            key[:16]))))
+    pattern = glob.escape(_p_).replace(
+        '{object}', 'material.*.' + '[0-9a-f]' * 16)
+    removed = []
+    for archive_filename in glob.glob(pattern):
+        if os.path.abspath(archive_filename) in current:
+            continue
+        try:
+            os.remove(archive_filename)
+            removed.append(archive_filename)
+        except OSError:
+            pass
+    return removed
+
+
+# export an archive with all the used materials and read it back in
+def export_materials_archive(ri, rpass, scene, data_blocks):
     if scene.renderman.external_animation:
         _p_ = user_path(scene.renderman.path_object_archive_animated, scene)
         archive_filename = _p_.replace('{object}', 'materials')
     else:
         _p_ = user_path(scene.renderman.path_object_archive_static, scene)
         archive_filename = _p_.replace('{object}', 'materials')
+    material_archives = export_material_archives(ri, rpass, scene,
+                                                 data_blocks)
     ri.Begin(archive_filename)
 
-    for mat_name, mat in bpy.data.materials.items():
-        ri.ArchiveBegin('material.' + get_mat_name(mat_name))
+    for mat, mat_archive in material_archives:
+        ri.ArchiveBegin('material.' + get_mat_name(mat.name))
         # ri.Attribute("identifier", {"name": mat_name})
-        export_material(ri, mat)
+        ri.ReadArchive(relpath_archive(mat_archive, rpass))
         ri.ArchiveEnd()
     ri.End()
 
@@ -3455,6 +4475,26 @@ def write_rib(rpass, scene, ri, visible_objects=None, engine=None, do_objects=Tr
 
     # precalculate motion blur data
     data_blocks, instances = cache_motion(scene, rpass)
+    try:
+        write_frame_rib(rpass, scene, ri, data_blocks, instances,
+                        visible_objects, engine, do_objects)
+    finally:
+        # samples of archives that weren't written, hair ones live in
+        # temp files
+        free_data_blocks(data_blocks)
+
+
+def write_frame_rib(rpass, scene, ri, data_blocks, instances, visible_objects, engine, do_objects):
+    # static archives already written for an earlier frame of this export
+    static_reuse = rpass.static_archive_reuse if do_objects else None
+    if static_reuse is not None:
+        static_reuse.skip_written(data_blocks)
+
+    # skip archives that haven't changed since they were last written
+    archive_cache = None
+    if scene.renderman.lazy_rib_gen and do_objects:
+        archive_cache = load_archive_cache(rpass)
+        check_archive_cache(scene, rpass, data_blocks, archive_cache)
 
     # get a list of empties to check if they contain a RIB archive.
     # this should be the only time empties are evaluated.
@@ -3462,7 +4502,10 @@ def write_rib(rpass, scene, ri, visible_objects=None, engine=None, do_objects=Tr
 
     if do_objects:
         # export rib archives of objects
-        export_data_archives(ri, scene, rpass, data_blocks, engine)
+        exported_blocks = export_data_archives(ri, scene, rpass, data_blocks,
+                                               engine, archive_cache)
+        if static_reuse is not None:
+            static_reuse.add_written(data_blocks, exported_blocks)
 
     export_header(ri)
     export_header_rib(ri, scene)
@@ -3501,12 +4544,14 @@ def write_rib(rpass, scene, ri, visible_objects=None, engine=None, do_objects=Tr
         export_world(ri, scene.world)
         export_scene_lights(ri, instances)
         export_default_bxdf(ri, "default")
-    export_materials_archive(ri, rpass, scene)
+    export_materials_archive(ri, rpass, scene, data_blocks)
     # now output the object archives
+    rpass.linking_index = LinkingIndex(scene)
     for name, instance in instances.items():
         if not instance.parent:
             export_instance_read_archive(
                 ri, instance, instances, data_blocks, rpass, visible_objects=visible_objects)
+    rpass.linking_index = None
 
     for object in emptiesToExport:
         export_empties_archives(ri, object)
@@ -3587,56 +4632,60 @@ def write_archive_RIB(rpass, scene, ri, object, overridePath, exportMats, export
     else:
         success = False
 
-    if success:
-        # export rib archives of objects
-        if(exportRange):
-            # Get range numbers from the timeline and use that as our range.
-            # This is how baking works so we should remain in line with how
-            #   blender wants to do things.
-            rangeStart = scene.frame_start
-            rangeEnd = scene.frame_end
-            rangeLength = rangeEnd - rangeStart
-            # Assume user is smart and wont pass us a negative range.
-            for i in range(rangeStart, rangeEnd + 1):
-                scene.frame_current = i
-                zeroFill = str(i).zfill(4)
-                data_blocks, instances = cache_motion(
-                    scene, rpass, objects=[object])
-                archivePathRIB = os.path.join(zeroFill, object.name + ".rib")
+    try:
+        if success:
+            # export rib archives of objects
+            if(exportRange):
+                # Get range numbers from the timeline and use that as our range.
+                # This is how baking works so we should remain in line with how
+                #   blender wants to do things.
+                rangeStart = scene.frame_start
+                rangeEnd = scene.frame_end
+                rangeLength = rangeEnd - rangeStart
+                # Assume user is smart and wont pass us a negative range.
+                for i in range(rangeStart, rangeEnd + 1):
+                    scene.frame_current = i
+                    zeroFill = str(i).zfill(4)
+                    free_data_blocks(data_blocks)
+                    data_blocks, instances = cache_motion(
+                        scene, rpass, objects=[object])
+                    archivePathRIB = os.path.join(zeroFill, object.name + ".rib")
+                    ri.Begin(archivePathRIB)
+                    if(exportMats):  # Bake in materials if asked.
+                        materialsList = object.material_slots
+                        # Convert any textures just in case.
+                        rpass.convert_textures(get_select_texture_list(object))
+                        for materialSlot in materialsList:
+                            ri.ArchiveBegin(os.path.join(
+                                zeroFill, 'material.' + materialSlot.name))
+                            export_material(ri, materialSlot.material)
+                            ri.ArchiveEnd()
+                    for name, db in data_blocks.items():
+                        db.do_export = True
+                    export_RIBArchive_data_archive(
+                        ri, scene, rpass, data_blocks, exportMats, True, True)
+                    ri.End()
+                # Reset back to start frame for niceties.
+                scene.frame_current = rangeStart
+            else:
+                archivePathRIB = object.name + ".rib"
                 ri.Begin(archivePathRIB)
-                if(exportMats):  # Bake in materials if asked.
+                # If we need to export material bake it in
+                if(exportMats):
                     materialsList = object.material_slots
-                    # Convert any textures just in case.
+                    # Convert any textures so they will be available on archive
+                    # load.
                     rpass.convert_textures(get_select_texture_list(object))
                     for materialSlot in materialsList:
-                        ri.ArchiveBegin(os.path.join(
-                            zeroFill, 'material.' + materialSlot.name))
+                        ri.ArchiveBegin('material.' + materialSlot.name)
                         export_material(ri, materialSlot.material)
                         ri.ArchiveEnd()
-                for name, db in data_blocks.items():
-                    db.do_export = True
                 export_RIBArchive_data_archive(
-                    ri, scene, rpass, data_blocks, exportMats, True, True)
+                    ri, scene, rpass, data_blocks, exportMats, False, True)
                 ri.End()
-            # Reset back to start frame for niceties.
-            scene.frame_current = rangeStart
-        else:
-            archivePathRIB = object.name + ".rib"
-            ri.Begin(archivePathRIB)
-            # If we need to export material bake it in
-            if(exportMats):
-                materialsList = object.material_slots
-                # Convert any textures so they will be available on archive
-                # load.
-                rpass.convert_textures(get_select_texture_list(object))
-                for materialSlot in materialsList:
-                    ri.ArchiveBegin('material.' + materialSlot.name)
-                    export_material(ri, materialSlot.material)
-                    ri.ArchiveEnd()
-            export_RIBArchive_data_archive(
-                ri, scene, rpass, data_blocks, exportMats, False, True)
             ri.End()
-        ri.End()
+    finally:
+        free_data_blocks(data_blocks)
 
     # Check if the file was created. I don't really think we need to check in
     # the .zip
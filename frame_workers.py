@@ -0,0 +1,236 @@
+# ##### BEGIN MIT LICENSE BLOCK #####
+#
+# Copyright (c) 2015 - 2017 Pixar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#
+# ##### END MIT LICENSE BLOCK #####
+
+
+# Generating the RIB for a frame range from several background Blender
+# processes.  The frame range is split into contiguous chunks, each chunk is
+# exported by a `blender -b` process running on the saved .blend, and the
+# workers print one progress line per frame that the UI process collects
+# to build the spool job.
+
+import bpy
+import os
+import sys
+import json
+import queue
+import subprocess
+import threading
+import traceback
+
+from .util import user_path, get_addon_prefs, debug
+from .engine import RPass
+from .export import get_texture_list, StaticArchiveReuse
+
+PROGRESS_PREFIX = 'RENDERMAN_RIBGEN '
+
+
+def get_denoise_aov_names(scene, display_driver):
+    addon_prefs = get_addon_prefs()
+    files = []
+    rm = scene.renderman
+    for layer in scene.render.layers:
+        # custom aovs
+        rm_rl = None
+        for render_layer_settings in rm.render_layers:
+            if layer.name == render_layer_settings.render_layer:
+                rm_rl = render_layer_settings
+        if rm_rl:
+            layer_name = layer.name.replace(' ', '')
+            if rm_rl.denoise_aov:
+                if rm_rl.export_multilayer:
+                    dspy_name = user_path(
+                        addon_prefs.path_aov_image, scene=scene, display_driver=display_driver,
+                        layer_name=layer_name, pass_name='multilayer')
+                    files.append(dspy_name)
+                else:
+                    for aov in rm_rl.custom_aovs:
+                        aov_name = aov.name.replace(' ', '')
+                        dspy_name = user_path(
+                            addon_prefs.path_aov_image, scene=scene, display_driver=display_driver,
+                            layer_name=layer_name, pass_name=aov_name)
+                        files.append(dspy_name)
+    return files
+
+
+# export one frame of an external render, returns what the spool job needs
+# to know about it
+def gen_frame(rpass, frame, do_rib, do_objects, convert_textures):
+    scene = rpass.scene
+    rm = scene.renderman
+    rpass.update_frame_num(frame)
+    outputs = {'frame': frame, 'error': '', 'textures': [],
+               'denoise': None, 'denoise_aov': None}
+    if do_rib:
+        try:
+            rpass.gen_rib(do_objects, convert_textures=False)
+        except Exception as err:
+            outputs['error'] = traceback.format_exc()
+    outputs['rib'] = rpass.paths['rib_output']
+    if convert_textures:
+        outputs['textures'] = get_texture_list(scene)
+    if rm.external_denoise:
+        outputs['denoise'] = rpass.get_denoise_names()
+        if rm.spool_denoise_aov:
+            outputs['denoise_aov'] = get_denoise_aov_names(
+                scene, rpass.display_driver)
+    return outputs
+
+
+def get_frame_chunks(frame_start, frame_end, num_chunks):
+    num_frames = frame_end - frame_start + 1
+    num_chunks = max(1, min(num_chunks, num_frames))
+    chunks = []
+    start = frame_start
+    for i in range(num_chunks):
+        size = num_frames // num_chunks + (1 if i < num_frames % num_chunks else 0)
+        chunks.append((start, start + size - 1))
+        start += size
+    return chunks
+
+
+def get_num_frame_workers(scene):
+    num_workers = scene.renderman.rib_gen_processes
+    if num_workers <= 0:
+        num_workers = max(1, (os.cpu_count() or 1) + num_workers)
+    return num_workers
+
+
+# ------------- Worker side -------------
+
+def report_progress(message):
+    sys.stdout.write(PROGRESS_PREFIX + json.dumps(message) + '\n')
+    sys.stdout.flush()
+
+
+# runs inside a background blender on the saved .blend
+def run_frame_worker(scene_name, frame_start, frame_end, do_objects,
+                     convert_textures, claim_dir):
+    scene = bpy.data.scenes[scene_name]
+    rm = scene.renderman
+    # the other workers already use the remaining cores
+    rm.parallel_archive_export = False
+    rpass = RPass(scene, external_render=True)
+    rpass.display_driver = rm.display_driver
+    # static archives are shared by all workers, whoever claims one first
+    # writes it
+    rpass.static_archive_reuse = StaticArchiveReuse(claim_dir)
+    for frame in range(frame_start, frame_end + 1):
+        report_progress(gen_frame(rpass, frame, True, do_objects,
+                                  convert_textures))
+    report_progress({'done': True,
+                     'summary': rpass.static_archive_reuse.summary()})
+
+
+# ------------- UI side -------------
+
+# one background blender exporting a chunk of frames.  its progress lines
+# are parsed on a reader thread and put on the shared messages queue as
+# (worker, message)
+class FrameWorker:
+
+    def __init__(self, scene, frame_start, frame_end, do_objects,
+                 convert_textures, claim_dir, messages):
+        self.frame_start = frame_start
+        self.frame_end = frame_end
+        self.done = False
+        addon_name = __name__.split('.')[0]
+        expr = '\n'.join([
+            'import addon_utils, importlib',
+            'if not addon_utils.check(%r)[1]:' % addon_name,
+            '    addon_utils.enable(%r)' % addon_name,
+            'importlib.import_module(%r).run_frame_worker(%r, %d, %d, %r, %r, %r)' %
+            (__name__, scene.name, frame_start, frame_end, do_objects,
+             convert_textures, claim_dir)])
+        self.process = subprocess.Popen(
+            [bpy.app.binary_path, '-b', bpy.data.filepath,
+             '--python-expr', expr],
+            stdout=subprocess.PIPE, stdin=subprocess.DEVNULL,
+            universal_newlines=True)
+        self.thread = threading.Thread(target=self.read_progress,
+                                       args=(messages,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read_progress(self, messages):
+        for line in self.process.stdout:
+            if not line.startswith(PROGRESS_PREFIX):
+                continue
+            try:
+                message = json.loads(line[len(PROGRESS_PREFIX):])
+            except ValueError:
+                continue
+            if message.get('done'):
+                self.done = True
+            messages.put((self, message))
+        self.process.wait()
+        messages.put((self, None))
+
+    def is_running(self):
+        return self.thread.is_alive()
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+
+
+def get_claim_dir(rpass):
+    claim_dir = os.path.join(rpass.paths['export_dir'], 'ribgen_claims')
+    if os.path.exists(claim_dir):
+        # left over from an export that didn't finish
+        remove_claim_dir(claim_dir)
+    os.makedirs(claim_dir)
+    return claim_dir
+
+
+def remove_claim_dir(claim_dir):
+    for name in os.listdir(claim_dir):
+        try:
+            os.remove(os.path.join(claim_dir, name))
+        except OSError:
+            pass
+    try:
+        os.rmdir(claim_dir)
+    except OSError:
+        debug('warning', 'Could not remove', claim_dir)
+
+
+def start_frame_workers(scene, rpass, do_objects, convert_textures):
+    messages = queue.Queue()
+    claim_dir = get_claim_dir(rpass)
+    workers = []
+    for frame_start, frame_end in get_frame_chunks(
+            scene.frame_start, scene.frame_end, get_num_frame_workers(scene)):
+        try:
+            workers.append(FrameWorker(scene, frame_start, frame_end,
+                                       do_objects, convert_textures,
+                                       claim_dir, messages))
+        except OSError:
+            debug('error', 'Could not start a RIB generation process',
+                  traceback.format_exc())
+            for worker in workers:
+                worker.kill()
+            remove_claim_dir(claim_dir)
+            return None, None, None
+    return workers, messages, claim_dir
@@ -27,8 +27,6 @@ import bpy
 import _cycles
 from bpy.app.handlers import persistent
 
-import xml.etree.ElementTree as ET
-
 import tempfile
 import nodeitems_utils
 import shutil
@@ -42,6 +40,7 @@ from .shader_parameters import node_add_outputs
 from .shader_parameters import socket_map
 from .shader_parameters import txmake_options, update_conditional_visops
 from .util import args_files_in_path
+from .args_cache import parse_args_files
 from .util import get_path_list
 from .util import rib
 from .util import debug
@@ -66,6 +65,7 @@ group_nodes = ['ShaderNodeGroup', 'NodeGroupInput', 'NodeGroupOutput']
 def update_func(self, context):
     # check if this prop is set on an input
     node = self.node if hasattr(self, 'node') else self
+    invalidate_textures(node.id_data)
 
     from . import engine
     if engine.is_ipr_running():
@@ -566,6 +566,7 @@ class RendermanOutputNode(RendermanShadingNode):
     # when a connection is made or removed see if we're in IPR mode and issue
     # updates
     def update(self):
+        invalidate_textures(self.id_data)
         from . import engine
         if engine.is_ipr_running():
             engine.ipr.last_edit_mat = None
@@ -668,6 +669,7 @@ def generate_node_type(prefs, name, args):
                                        default=name, options={'HIDDEN'})
     # lights cant connect to a node tree in 20.0
     class_generate_properties(ntype, name, inputs + outputs)
+    ntype.param_plan = compile_param_plan(ntype.prop_meta, name, typename)
     if nodeType == 'light':
         ntype.light_shading_rate = FloatProperty(
             name="Light Shading Rate",
@@ -1305,6 +1307,68 @@ gains_to_enable = {
     'glowGain': 'enableGlow',
 }
 
+# how gen_params exports each property of a node type, as tuples of
+# (prop_name, meta, param, ref_param, vstruct, gain, kind).  all of it
+# only depends on the args file of the node, so it is worked out once per
+# node type and exporting a node only checks its links and reads its values.
+# vstruct is the (name, member) of a vstruct member, gain the lobe switch of
+# a PxrSurface gain, and kind how the value is written, None for structs and
+# enums that are only written when linked
+def compile_param_plan(prop_meta, plugin_name, bl_idname):
+    plan = []
+    for prop_name, meta in prop_meta.items():
+        if prop_name in txmake_options.index:
+            continue
+        elif plugin_name == 'PxrRamp' and prop_name in ['colors', 'positions']:
+            continue
+        elif prop_name in ['sblur', 'tblur', 'notes']:
+            continue
+        elif meta['renderman_type'] == 'page':
+            continue
+        elif prop_name == 'inputMaterial' or \
+                ('type' in meta and meta['type'] == 'vstruct'):
+            continue
+
+        param = '%s %s' % (meta['renderman_type'], meta['renderman_name'])
+        if 'arraySize' in meta:
+            ref_param = 'reference %s[1] %s' % (meta['renderman_type'],
+                                                meta['renderman_name'])
+        else:
+            ref_param = 'reference ' + param
+
+        vstruct = tuple(meta['vstructmember'].split('.')) \
+            if 'vstructmember' in meta else None
+
+        gain = gains_to_enable.get(prop_name) \
+            if bl_idname == 'PxrSurfaceBxdfNode' else None
+
+        if meta['renderman_type'] in ['struct', 'enum']:
+            kind = None
+        elif 'options' in meta and meta['options'] == 'texture' \
+                and bl_idname != "PxrPtexturePatternNode" or \
+                ('widget' in meta and meta['widget'] == 'assetIdInput' and prop_name != 'iesProfile'):
+            kind = 'texture'
+        elif 'arraySize' in meta:
+            kind = 'array'
+        else:
+            kind = 'value'
+
+        plan.append((prop_name, meta, param, ref_param, vstruct, gain, kind))
+    return plan
+
+
+# the param plan of a node's type, node types not made by generate_node_type
+# get theirs the first time they are exported
+def get_param_plan(node):
+    ntype = type(node)
+    plan = getattr(ntype, 'param_plan', None)
+    if plan is None:
+        plan = compile_param_plan(node.prop_meta, node.plugin_name,
+                                  node.bl_idname)
+        ntype.param_plan = plan
+    return plan
+
+
 # generate param list
 
 
@@ -1374,109 +1438,71 @@ def gen_params(ri, node, mat_name=None):
 
     else:
 
-        for prop_name, meta in node.prop_meta.items():
-            if prop_name in txmake_options.index:
-                pass
-            elif node.plugin_name == 'PxrRamp' and prop_name in ['colors', 'positions']:
-                pass
+        for prop_name, meta, param, ref_param, vstruct, gain, kind in \
+                get_param_plan(node):
+            to_socket = node.inputs.get(prop_name)
+            # if input socket is linked reference that
+            if to_socket is not None and to_socket.is_linked:
+                from_socket = to_socket.links[0].from_socket
+                from_node = to_socket.links[0].from_node
+                params[ref_param] = [get_output_param_str(
+                    from_node, mat_name, from_socket, to_socket)]
+
+            # see if vstruct linked
+            elif vstruct and is_vstruct_and_linked(node, prop_name):
+                vstruct_name, vstruct_member = vstruct
+                from_socket = node.inputs[
+                    vstruct_name].links[0].from_socket
+
+                temp_mat_name = mat_name
+
+                if from_socket.node.bl_idname == 'ShaderNodeGroup':
+                    ng = from_socket.node.node_tree
+                    group_output = next((n for n in ng.nodes if n.bl_idname == 'NodeGroupOutput'),
+                                        None)
+                    if group_output is None:
+                        return False
+
+                    in_sock = group_output.inputs[from_socket.name]
+                    if len(in_sock.links):
+                        from_socket = in_sock.links[0].from_socket
+                        temp_mat_name = mat_name + '.' + from_socket.node.name
+
+                vstruct_from_param = "%s_%s" % (
+                    from_socket.identifier, vstruct_member)
+                if vstruct_from_param in from_socket.node.output_meta:
+                    actual_socket = from_socket.node.output_meta[
+                        vstruct_from_param]
+                    params[ref_param] = [get_output_param_str(
+                        from_socket.node, temp_mat_name, actual_socket)]
+                else:
+                    print('Warning! %s not found on %s' %
+                          (vstruct_from_param, from_socket.node.name))
 
-            elif(prop_name in ['sblur', 'tblur', 'notes']):
-                pass
+            # if struct is not linked continue
+            elif kind is None:
+                continue
 
+            # if this is a gain on PxrSurface and the lobe isn't
+            # enabled
+            elif gain and not getattr(node, gain):
+                params[param] = [0, 0, 0] if meta[
+                    'renderman_type'] == 'color' else 0
+
+            # else output rib
             else:
                 prop = getattr(node, prop_name)
-                # if property group recurse
-                if meta['renderman_type'] == 'page':
-                    continue
-                elif prop_name == 'inputMaterial' or \
-                        ('type' in meta and meta['type'] == 'vstruct'):
-                    continue
-
-                # if input socket is linked reference that
-                elif hasattr(node, 'inputs') and prop_name in node.inputs and \
-                        node.inputs[prop_name].is_linked:
-
-                    to_socket = node.inputs[prop_name]
-                    from_socket = to_socket.links[0].from_socket
-                    from_node = to_socket.links[0].from_node
-                    if 'arraySize' in meta:
-                        params['reference %s[1] %s' % (meta['renderman_type'],
-                                              meta['renderman_name'])] \
-                            = [get_output_param_str(
-                                from_node, mat_name, from_socket, to_socket)]
-                    else:
-                        params['reference %s %s' % (meta['renderman_type'],
-                                                meta['renderman_name'])] = \
-                            [get_output_param_str(
-                                from_node, mat_name, from_socket, to_socket)]
-
-                # see if vstruct linked
-                elif is_vstruct_and_linked(node, prop_name):
-                    vstruct_name, vstruct_member = meta[
-                        'vstructmember'].split('.')
-                    from_socket = node.inputs[
-                        vstruct_name].links[0].from_socket
-
-                    temp_mat_name = mat_name
-
-                    if from_socket.node.bl_idname == 'ShaderNodeGroup':
-                        ng = from_socket.node.node_tree
-                        group_output = next((n for n in ng.nodes if n.bl_idname == 'NodeGroupOutput'),
-                                            None)
-                        if group_output is None:
-                            return False
-
-                        in_sock = group_output.inputs[from_socket.name]
-                        if len(in_sock.links):
-                            from_socket = in_sock.links[0].from_socket
-                            temp_mat_name = mat_name + '.' + from_socket.node.name
-
-                    vstruct_from_param = "%s_%s" % (
-                        from_socket.identifier, vstruct_member)
-                    if vstruct_from_param in from_socket.node.output_meta:
-                        actual_socket = from_socket.node.output_meta[
-                            vstruct_from_param]
-                        params['reference %s %s' % (meta['renderman_type'],
-                                                    meta['renderman_name'])] = \
-                            [get_output_param_str(
-                                from_socket.node, temp_mat_name, actual_socket)]
-                    else:
-                        print('Warning! %s not found on %s' %
-                              (vstruct_from_param, from_socket.node.name))
-
-                # else output rib
+                if kind == 'texture':
+                    params[param] = rib(get_tex_file_name(prop),
+                                        type_hint=meta['renderman_type'])
+                elif kind == 'array':
+                    if type(prop) == int:
+                        prop = [prop]
+                    params['%s[%d] %s' % (meta['renderman_type'], len(prop),
+                                          meta['renderman_name'])] \
+                        = rib(prop)
                 else:
-                    # if struct is not linked continue
-                    if meta['renderman_type'] in ['struct', 'enum']:
-                        continue
-
-                    # if this is a gain on PxrSurface and the lobe isn't
-                    # enabled
-                    if node.bl_idname == 'PxrSurfaceBxdfNode' and \
-                            prop_name in gains_to_enable and \
-                            not getattr(node, gains_to_enable[prop_name]):
-                        val = [0, 0, 0] if meta[
-                            'renderman_type'] == 'color' else 0
-                        params['%s %s' % (meta['renderman_type'],
-                                          meta['renderman_name'])] = val
-
-                    elif 'options' in meta and meta['options'] == 'texture' \
-                            and node.bl_idname != "PxrPtexturePatternNode" or \
-                            ('widget' in meta and meta['widget'] == 'assetIdInput' and prop_name != 'iesProfile'):
-                        params['%s %s' % (meta['renderman_type'],
-                                          meta['renderman_name'])] = \
-                            rib(get_tex_file_name(prop),
-                                type_hint=meta['renderman_type'])
-                    elif 'arraySize' in meta:
-                        if type(prop) == int:
-                            prop = [prop]
-                        params['%s[%d] %s' % (meta['renderman_type'], len(prop),
-                                              meta['renderman_name'])] \
-                            = rib(prop)
-                    else:
-                        params['%s %s' % (meta['renderman_type'],
-                                          meta['renderman_name'])] = \
-                            rib(prop, type_hint=meta['renderman_type'])
+                    params[param] = rib(prop, type_hint=meta['renderman_type'])
     if node.plugin_name == 'PxrRamp':
         nt = bpy.data.node_groups[node.node_group]
         if nt:
@@ -2056,31 +2082,42 @@ def is_float3_type(socket):
 # walk the tree for nodes to export
 
 
+# the nodes to export for the graph feeding node, each after the nodes it
+# reads from, with converter tuples where float and float3 sockets meet.
+# every node is only visited once, even when several nodes read from it
 def gather_nodes(node):
     nodes = []
-    for socket in node.inputs:
-        if socket.is_linked:
-            link = socket.links[0]
-            for sub_node in gather_nodes(socket.links[0].from_node):
-                if sub_node not in nodes:
-                    nodes.append(sub_node)
-
-            # if this is a float -> color inset a tofloat3
-            if is_float_type(link.from_socket) and is_float3_type(socket):
-                convert_node = ('PxrToFloat3', link.from_node,
-                                link.from_socket)
-                if convert_node not in nodes:
-                    nodes.append(convert_node)
-            elif is_float3_type(link.from_socket) and is_float_type(socket):
-                convert_node = ('PxrToFloat', link.from_node, link.from_socket)
-                if convert_node not in nodes:
-                    nodes.append(convert_node)
-
-    if hasattr(node, 'renderman_node_type') and node.renderman_node_type != 'output':
-        nodes.append(node)
-    elif not hasattr(node, 'renderman_node_type') and node.bl_idname not in ['ShaderNodeOutputMaterial', 'NodeGroupInput', 'NodeGroupOutput']:
-        nodes.append(node)
-
+    visited = set()
+
+    def gather(node):
+        visited.add(node.as_pointer())
+        for socket in node.inputs:
+            if socket.is_linked:
+                link = socket.links[0]
+                if link.from_node.as_pointer() not in visited:
+                    gather(link.from_node)
+
+                # if this is a float -> color inset a tofloat3
+                convert_node = None
+                if is_float_type(link.from_socket) and is_float3_type(socket):
+                    convert_node = ('PxrToFloat3', link.from_node,
+                                    link.from_socket)
+                elif is_float3_type(link.from_socket) and is_float_type(socket):
+                    convert_node = ('PxrToFloat', link.from_node,
+                                    link.from_socket)
+                if convert_node:
+                    key = (convert_node[0], link.from_node.as_pointer(),
+                           link.from_socket.as_pointer())
+                    if key not in visited:
+                        visited.add(key)
+                        nodes.append(convert_node)
+
+        if hasattr(node, 'renderman_node_type') and node.renderman_node_type != 'output':
+            nodes.append(node)
+        elif not hasattr(node, 'renderman_node_type') and node.bl_idname not in ['ShaderNodeOutputMaterial', 'NodeGroupInput', 'NodeGroupOutput']:
+            nodes.append(node)
+
+    gather(node)
     return nodes
 
 
@@ -2124,7 +2161,9 @@ def export_shader_nodetree(ri, id, handle=None, disp_bound=0.0, iterate_instance
             print("Error Material %s needs a RenderMan BXDF" % id.name)
 
 
-def get_textures_for_node(node, matName=""):
+# the textures a node reads, as (prop, options, skip_tex) with the frame
+# number still in prop.  trees collects the node trees they came from
+def get_texture_sources_for_node(node, trees=None):
     textures = []
     if hasattr(node, 'bl_idname'):
         if node.bl_idname == "PxrPtexturePatternNode":
@@ -2133,15 +2172,15 @@ def get_textures_for_node(node, matName=""):
             for input_name, input in node.inputs.items():
                 if hasattr(input, 'is_texture') and input.is_texture:
                     prop = input.default_value
-                    out_file_name = get_tex_file_name(prop)
-                    textures.append((replace_frame_num(prop), out_file_name,
-                                     ['-smode', 'periodic', '-tmode',
-                                      'periodic']))
+                    textures.append((prop, ['-smode', 'periodic', '-tmode',
+                                            'periodic'], False))
             return textures
         elif node.bl_idname == 'ShaderNodeGroup':
             nt = node.node_tree
+            if trees is not None:
+                trees.add(nt.as_pointer())
             for node in nt.nodes:
-                textures.extend(get_textures_for_node(node, matName=""))
+                textures.extend(get_texture_sources_for_node(node, trees))
             return textures
 
     if hasattr(node, 'prop_meta'):
@@ -2159,64 +2198,114 @@ def get_textures_for_node(node, matName=""):
                     if ('options' in meta and meta['options'] == 'texture') or \
                         (node.renderman_node_type == 'light' and
                             'widget' in meta and meta['widget'] == 'assetIdInput' and prop_name != 'iesProfile'):
-                        out_file_name = get_tex_file_name(prop)
-                        # if they don't match add this to the list
-                        if out_file_name != prop:
-                            if node.renderman_node_type == 'light' and \
-                                    "Dome" in node.bl_label:
-                                # no options for now
-                                textures.append(
-                                    (replace_frame_num(prop), out_file_name, ['-envlatl']))
-                            else:
-                                # Test and see if options like smode are on
-                                # this node.
-                                if hasattr(node, "smode"):
-                                    optionsList = []
-                                    for option in txmake_options.index:
-                                        partsOfOption = getattr(
-                                            txmake_options, option)
-                                        if partsOfOption["exportType"] == "name":
-                                            optionsList.append("-" + option)
-                                            # Float values need converting
-                                            # before they are passed to command
-                                            # line
-                                            if partsOfOption["type"] == "float":
-                                                optionsList.append(
-                                                    str(getattr(node, option)))
-                                            else:
-                                                optionsList.append(
-                                                    getattr(node, option))
+                        if node.renderman_node_type == 'light' and \
+                                "Dome" in node.bl_label:
+                            # no options for now
+                            textures.append((prop, ['-envlatl'], True))
+                        else:
+                            # Test and see if options like smode are on
+                            # this node.
+                            if hasattr(node, "smode"):
+                                optionsList = []
+                                for option in txmake_options.index:
+                                    partsOfOption = getattr(
+                                        txmake_options, option)
+                                    if partsOfOption["exportType"] == "name":
+                                        optionsList.append("-" + option)
+                                        # Float values need converting
+                                        # before they are passed to command
+                                        # line
+                                        if partsOfOption["type"] == "float":
+                                            optionsList.append(
+                                                str(getattr(node, option)))
+                                        else:
+                                            optionsList.append(
+                                                getattr(node, option))
+                                    else:
+                                        # Float values need converting
+                                        # before they are passed to command
+                                        # line
+                                        if partsOfOption["type"] == "float":
+                                            optionsList.append(
+                                                str(getattr(node, option)))
                                         else:
-                                            # Float values need converting
-                                            # before they are passed to command
-                                            # line
-                                            if partsOfOption["type"] == "float":
-                                                optionsList.append(
-                                                    str(getattr(node, option)))
-                                            else:
-                                                optionsList.append(
-                                                    "-" + getattr(node, option))
-                                    textures.append(
-                                        (replace_frame_num(prop), out_file_name, optionsList))
-                                else:
-                                    # no options found add the bare minimum
-                                    # options for smooth export.
-                                    textures.append((replace_frame_num(prop), out_file_name,
-                                                     ['-smode', 'periodic',
-                                                      '-tmode', 'periodic']))
+                                            optionsList.append(
+                                                "-" + getattr(node, option))
+                                textures.append((prop, optionsList, True))
+                            else:
+                                # no options found add the bare minimum
+                                # options for smooth export.
+                                textures.append((prop,
+                                                 ['-smode', 'periodic',
+                                                  '-tmode', 'periodic'], True))
     return textures
 
 
-def get_textures(id):
+# turn texture sources into (in name, out name, options) for the current
+# frame
+def expand_texture_sources(sources):
     textures = []
+    for prop, options, skip_tex in sources:
+        out_file_name = get_tex_file_name(prop)
+        # if they don't match add this to the list
+        if skip_tex and out_file_name == prop:
+            continue
+        textures.append((replace_frame_num(prop), out_file_name, options))
+    return textures
+
+
+def get_textures_for_node(node, matName=""):
+    return expand_texture_sources(get_texture_sources_for_node(node))
+
+
+# Texture inventory.  The texture sources of every material and light node
+# tree are kept here so a scene's textures can be listed each frame without
+# going over all of its nodes.  An entry is dropped when one of the trees it
+# was made from is edited, and is rebuilt if the number of nodes changed.
+texture_inventory = {}
+
+
+def invalidate_textures(nt):
+    if nt is None:
+        return
+    pointer = nt.as_pointer()
+    for key, entry in list(texture_inventory.items()):
+        if pointer in entry[1]:
+            del texture_inventory[key]
+
+
+@persistent
+def clear_texture_inventory(*args):
+    texture_inventory.clear()
+
+
+def get_cached_texture_sources(key, nt, nodes):
+    entry = texture_inventory.get(key)
+    if entry is None or entry[0] != len(nt.nodes):
+        trees = set([nt.as_pointer()])
+        sources = []
+        for node in nodes:
+            sources.extend(get_texture_sources_for_node(node, trees))
+        entry = (len(nt.nodes), trees, sources)
+        texture_inventory[key] = entry
+    return entry[2]
+
+
+def get_light_textures(node):
+    if node is None:
+        return []
+    nt = node.id_data
+    return expand_texture_sources(get_cached_texture_sources(
+        (nt.as_pointer(), node.name), nt, [node]))
+
+
+def get_textures(id):
     if id is None or not id.node_tree:
-        return textures
+        return []
 
     nt = id.node_tree
-    for node in nt.nodes:
-        textures.extend(get_textures_for_node(node, id.name))
-
-    return textures
+    return expand_texture_sources(get_cached_texture_sources(
+        (id.as_pointer(), nt.as_pointer()), nt, nt.nodes))
 
 
 pattern_node_categories_map = {"texture": ["PxrFractal", "PxrBakeTexture", "PxrBakePointCloud", "PxrProjectionLayer", "PxrPtexture", "PxrTexture", "PxrVoronoise", "PxrWorley", "PxrFractalize", "PxrDirt", "PxrLayeredTexture", "PxrMultiTexture"],
@@ -2262,18 +2351,33 @@ nodetypes = {}
 pattern_categories = {}
 
 
+# where the parsed args files are cached between launches
+def get_args_cache_dir():
+    try:
+        return bpy.utils.user_resource('DATAFILES', 'renderman', create=True)
+    except Exception:
+        return None
+
+
 def register():
     for cls in classes:
         bpy.utils.register_class(cls)
 
+    for handlers in (bpy.app.handlers.load_post, bpy.app.handlers.undo_post,
+                     bpy.app.handlers.redo_post):
+        if clear_texture_inventory not in handlers:
+            handlers.append(clear_texture_inventory)
+
     user_preferences = bpy.context.user_preferences
     prefs = user_preferences.addons[__package__].preferences
 
     categories = {}
 
-    for name, arg_file in args_files_in_path(prefs, None).items():
+    args = parse_args_files(args_files_in_path(prefs, None),
+                            get_args_cache_dir())
+    for name, args_root in args.items():
         try:
-            vals = generate_node_type(prefs, name, ET.parse(arg_file).getroot())
+            vals = generate_node_type(prefs, name, args_root)
             if vals:
                 typename, nodetype = vals
                 nodetypes[typename] = nodetype
@@ -2338,6 +2442,10 @@ def register():
 
 def unregister():
     nodeitems_utils.unregister_node_categories("RENDERMANSHADERNODES")
+    for handlers in (bpy.app.handlers.load_post, bpy.app.handlers.undo_post,
+                     bpy.app.handlers.redo_post):
+        if clear_texture_inventory in handlers:
+            handlers.remove(clear_texture_inventory)
     # bpy.utils.unregister_module(__name__)
 
     for cls in classes:
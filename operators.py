@@ -25,6 +25,7 @@
 
 import bpy
 import os
+import queue
 import subprocess
 import bgl
 import blf
@@ -47,11 +48,14 @@ from .util import readOSO, find_it_path, find_local_queue, find_tractor_spool
 from .util import get_Files_in_Directory
 
 from .export import export_archive
-from .export import get_texture_list
+from .export import get_texture_list, texture_key
 from .engine import RPass
 from .export import debug
 from .export import write_archive_RIB
 from .export import EXCLUDED_OBJECT_TYPES
+from .export import StaticArchiveReuse
+from .export import clean_material_archives
+from .frame_workers import gen_frame, start_frame_workers, remove_claim_dir
 from . import engine
 
 from .nodes import convert_cycles_nodetree, is_renderman_nodetree
@@ -59,6 +63,7 @@ from .nodes import convert_cycles_nodetree, is_renderman_nodetree
 #from .nodes import RendermanPatternGraph
 
 from .spool import spool_render
+from .texture_manifest import clean_texture_dir
 
 from bpy_extras.io_utils import ExportHelper
 
@@ -96,6 +101,40 @@ class Renderman_start_it(bpy.types.Operator):
         return {'FINISHED'}
 
 
+class Renderman_clean_textures(bpy.types.Operator):
+    bl_idname = 'rman.clean_textures'
+    bl_label = "Clean Texture Cache"
+    bl_description = "Remove converted textures whose source file no longer exists from the texture output folder"
+
+    remove_untracked:  BoolProperty(
+        name="Remove Untracked",
+        description="Also remove .tex files the texture manifest doesn't know about",
+        default=False)
+
+    def execute(self, context):
+        scene = context.scene
+        texture_dir = user_path(scene.renderman.path_texture_output,
+                                scene=scene)
+        if not os.path.isdir(texture_dir):
+            self.report({'INFO'}, 'No texture cache at %s' % texture_dir)
+            return {'FINISHED'}
+        removed = clean_texture_dir(texture_dir, self.remove_untracked)
+        self.report({'INFO'}, 'Removed %d textures from %s' %
+                    (len(removed), texture_dir))
+        return {'FINISHED'}
+
+
+class Renderman_clean_material_archives(bpy.types.Operator):
+    bl_idname = 'rman.clean_material_archives'
+    bl_label = "Clean Material Archives"
+    bl_description = "Remove material archives written for earlier versions of the materials from the static archive folder"
+
+    def execute(self, context):
+        removed = clean_material_archives(context.scene)
+        self.report({'INFO'}, 'Removed %d material archives' % len(removed))
+        return {'FINISHED'}
+
+
 class Renderman_open_last_RIB(bpy.types.Operator):
     bl_idname = 'rman.open_rib'
     bl_label = "Open Last RIB Scene file."
@@ -337,38 +376,11 @@ class ExternalRender(bpy.types.Operator):
     rpass = None
     is_running = False
 
-    def gen_rib_frame(self, rpass, do_objects):
-        try:
-            rpass.gen_rib(do_objects, convert_textures=False)
-        except Exception as err:
-            self.report({'ERROR'}, 'Rib gen error: ' + traceback.format_exc())
-
-    def gen_denoise_aov_name(self, scene, rpass):
-        addon_prefs = get_addon_prefs()
-        files = []
-        rm = scene.renderman
-        for layer in scene.render.layers:
-            # custom aovs
-            rm_rl = None
-            for render_layer_settings in rm.render_layers:
-                if layer.name == render_layer_settings.render_layer:
-                    rm_rl = render_layer_settings
-            if rm_rl:
-                layer_name = layer.name.replace(' ', '')
-                if rm_rl.denoise_aov:
-                    if rm_rl.export_multilayer:
-                        dspy_name = user_path(
-                            addon_prefs.path_aov_image, scene=scene, display_driver=rpass.display_driver,
-                            layer_name=layer_name, pass_name='multilayer')
-                        files.append(dspy_name)
-                    else:
-                        for aov in rm_rl.custom_aovs:
-                            aov_name = aov.name.replace(' ', '')
-                            dspy_name = user_path(
-                                addon_prefs.path_aov_image, scene=scene, display_driver=rpass.display_driver,
-                                layer_name=layer_name, pass_name=aov_name)
-                            files.append(dspy_name)
-        return files
+    def add_frame(self, outputs):
+        if outputs['error']:
+            self.report({'ERROR'}, 'Rib gen error: ' + outputs['error'])
+        outputs['textures'] = [tuple(cmd) for cmd in outputs['textures']]
+        self.frames[outputs['frame']] = outputs
 
     def execute(self, context):
         if engine.ipr:
@@ -393,51 +405,154 @@ class ExternalRender(bpy.types.Operator):
 
         # rib gen each frame
         rpass.display_driver = scene.renderman.display_driver
-        rib_names = []
-        denoise_files = []
-        denoise_aov_files = []
-        job_tex_cmds = []
-        frame_tex_cmds = {}
+        self.rpass = rpass
+        self.frames = {}
+        self.job_tex_cmds = []
         if rm.external_animation:
             rpass.update_frame_num(scene.frame_end + 1)
             rpass.update_frame_num(scene.frame_start)
             if rm.convert_textures:
-                tmp_tex_cmds = get_texture_list(rpass.scene)
-                tmp2_cmds = get_texture_list(rpass.scene)
-                job_tex_cmds = [
-                    cmd for cmd in tmp_tex_cmds if cmd in tmp2_cmds]
+                job_tex_keys = set()
+                for cmd in get_texture_list(rpass.scene):
+                    if texture_key(cmd) not in job_tex_keys:
+                        job_tex_keys.add(texture_key(cmd))
+                        self.job_tex_cmds.append(cmd)
+
+            if do_rib and rm.distributed_rib_gen and \
+                    self.start_workers(context):
+                return {'RUNNING_MODAL'}
+
+            # write the static archives once for the whole range
+            if do_rib and do_objects and scene.frame_start != scene.frame_end:
+                rpass.static_archive_reuse = StaticArchiveReuse()
 
             for frame in range(scene.frame_start, scene.frame_end + 1):
-                rpass.update_frame_num(frame)
                 if do_rib:
                     self.report(
-                        {'INFO'}, 'RenderMan External Rendering generating rib for frame %d' % scene.frame_current)
-                    self.gen_rib_frame(rpass, do_objects)
-                rib_names.append(rpass.paths['rib_output'])
-                if rm.convert_textures:
-                    frame_tex_cmds[frame] = [cmd for cmd in get_texture_list(
-                        rpass.scene) if cmd not in job_tex_cmds]
-                if rm.external_denoise:
-                    denoise_files.append(rpass.get_denoise_names())
-                    if rm.spool_denoise_aov:
-                        denoise_aov_files.append(
-                            self.gen_denoise_aov_name(scene, rpass))
+                        {'INFO'}, 'RenderMan External Rendering generating rib for frame %d' % frame)
+                self.add_frame(gen_frame(rpass, frame, do_rib, do_objects,
+                                         rm.convert_textures))
+
+            if rpass.static_archive_reuse is not None:
+                self.report({'INFO'}, 'RenderMan External Rendering %s' %
+                            rpass.static_archive_reuse.summary())
+                rpass.static_archive_reuse = None
 
         else:
             if do_rib:
                 self.report(
                     {'INFO'}, 'RenderMan External Rendering generating rib for frame %d' % scene.frame_current)
-                self.gen_rib_frame(rpass, do_objects)
-            rib_names.append(rpass.paths['rib_output'])
+            self.add_frame(gen_frame(rpass, scene.frame_current, do_rib,
+                                     do_objects, rm.convert_textures))
+
+        self.spool(context)
+        return {'FINISHED'}
+
+    # hand the frame range to background blenders, the modal handler
+    # collects their progress and spools once they are all done
+    def start_workers(self, context):
+        scene = context.scene
+        if context.window is None:
+            return False
+        if not bpy.data.filepath or bpy.data.is_dirty:
+            self.report({'WARNING'}, 'Save the .blend file to distribute RIB '
+                        'generation, generating RIB here instead')
+            return False
+        self.workers, self.messages, self.claim_dir = start_frame_workers(
+            scene, self.rpass, scene.renderman.generate_object_rib,
+            scene.renderman.convert_textures)
+        if not self.workers:
+            self.report({'WARNING'}, 'Could not start RIB generation '
+                        'processes, generating RIB here instead')
+            return False
+        self.num_frames = scene.frame_end - scene.frame_start + 1
+        self.report({'INFO'}, 'RenderMan External Rendering generating rib '
+                    'for %d frames in %d processes' %
+                    (self.num_frames, len(self.workers)))
+        wm = context.window_manager
+        wm.progress_begin(0, self.num_frames)
+        self.timer = wm.event_timer_add(0.25, context.window)
+        wm.modal_handler_add(self)
+        return True
+
+    def stop_workers(self, context):
+        for worker in self.workers:
+            worker.kill()
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        remove_claim_dir(self.claim_dir)
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.cancel(context)
+            self.report({'WARNING'}, 'RenderMan External Rendering '
+                        'cancelled RIB generation')
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        while True:
+            try:
+                worker, message = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if message is None:
+                if not worker.done:
+                    self.report({'ERROR'}, 'RenderMan RIB generation for '
+                                'frames %d - %d exited early' %
+                                (worker.frame_start, worker.frame_end))
+            elif message.get('done'):
+                debug('info', 'RIB generation for frames %d - %d %s' %
+                      (worker.frame_start, worker.frame_end,
+                       message['summary']))
+            else:
+                self.add_frame(message)
+                self.report({'INFO'}, 'RenderMan External Rendering '
+                            'generated rib for frame %d' % message['frame'])
+                context.window_manager.progress_update(len(self.frames))
+
+        if any(worker.is_running() for worker in self.workers) or \
+                not self.messages.empty():
+            return {'PASS_THROUGH'}
+
+        self.stop_workers(context)
+        if len(self.frames) < self.num_frames:
+            self.report({'ERROR'}, 'RenderMan RIB generation failed for %d '
+                        'frames, not spooling' %
+                        (self.num_frames - len(self.frames)))
+            self.rpass = None
+            return {'CANCELLED'}
+        self.spool(context)
+        return {'FINISHED'}
+
+    def cancel(self, context):
+        self.stop_workers(context)
+        self.rpass = None
+
+    # gen spool job
+    def spool(self, context):
+        scene = context.scene
+        rm = scene.renderman
+        rpass = self.rpass
+        job_tex_cmds = self.job_tex_cmds
+        job_tex_keys = set(texture_key(cmd) for cmd in job_tex_cmds)
+        rib_names = []
+        denoise_files = []
+        denoise_aov_files = []
+        frame_tex_cmds = {}
+        for frame in sorted(self.frames):
+            outputs = self.frames[frame]
+            rib_names.append(outputs['rib'])
             if rm.convert_textures:
-                frame_tex_cmds = {scene.frame_current: get_texture_list(scene)}
+                frame_tex_cmds[frame] = [
+                    cmd for cmd in outputs['textures']
+                    if texture_key(cmd) not in job_tex_keys]
             if rm.external_denoise:
-                denoise_files.append(rpass.get_denoise_names())
+                denoise_files.append(outputs['denoise'])
                 if rm.spool_denoise_aov:
-                    denoise_aov_files.append(
-                        self.gen_denoise_aov_name(scene, rpass))
+                    denoise_aov_files.append(outputs['denoise_aov'])
 
-        # gen spool job
         if rm.generate_alf:
             denoise = rm.external_denoise
             to_render = rm.generate_render
@@ -457,8 +572,7 @@ class ExternalRender(bpy.types.Operator):
                     {'INFO'}, 'RenderMan External Rendering spooling to %s.' % rm.queuing_system)
                 subprocess.Popen([exe, alf_file])
 
-        rpass = None
-        return {'FINISHED'}
+        self.rpass = None
 
 
 class StartInteractive(bpy.types.Operator):
@@ -757,6 +757,21 @@ class RendermanSceneSettings(bpy.types.PropertyGroup):
         description="On unchanged objects, don't re-emit rib.  Will result in faster spooling of renders",
         default=True)
 
+    parallel_archive_export:  BoolProperty(
+        name="Parallel Archive Export",
+        description="Write object RIB archives from several worker processes at once.  Blender data is still read on the main thread",
+        default=False)
+
+    archive_export_processes:  IntProperty(
+        name="Archive Export Processes",
+        description="Number of worker processes writing object archives.  Note, 0 uses all cores, -1 uses all cores but one",
+        min=-32, max=128, default=0)
+
+    texture_conversion_processes:  IntProperty(
+        name="Texture Conversion Processes",
+        description="Number of txmake processes converting textures at once.  Note, 0 uses all cores, -1 uses all cores but one",
+        min=-32, max=128, default=0)
+
     always_generate_textures:  BoolProperty(
         name="Always Recompile Textures",
         description="Recompile used textures at export time to the current rib folder. Leave this unchecked to speed up re-render times",
@@ -928,6 +943,16 @@ class RendermanSceneSettings(bpy.types.PropertyGroup):
         description="Spool Animation",
         default=False)
 
+    distributed_rib_gen:  BoolProperty(
+        name="Distribute RIB Generation",
+        description="Generate the RIB for the frame range from several background Blender processes running on the saved .blend file",
+        default=False)
+
+    rib_gen_processes:  IntProperty(
+        name="RIB Generation Processes",
+        description="Number of background Blender processes generating RIB.  Note, 0 uses all cores, -1 uses all cores but one",
+        min=-32, max=128, default=0)
+
     enable_checkpoint:  BoolProperty(
         name="Enable Checkpointing",
         description="Allows partial images to be output at specific intervals while the renderer continued to run.  The user may also set a point at which the render will terminate",
@@ -1910,6 +1935,15 @@ class RendermanParticleSettings(bpy.types.PropertyGroup):
         description="Object to instance on every particle",
         default="")
 
+    instance_mode:  EnumProperty(
+        name="Instancing",
+        description="How the instances on the particles are written",
+        items=[('PER_INSTANCE', 'Per Instance',
+                'A full attribute block with its own coordinate system for every particle'),
+               ('BATCH', 'Batch',
+                'Compute the transforms of all particles at once and only write the transform, user attributes and instance of each particle.  Much faster and smaller for millions of particles')],
+        default='PER_INSTANCE')
+
     round_hair:  BoolProperty(
         name="Round Hair",
         description="Render curves as round cylinders or ribbons.  Round is faster and recommended for hair",
@@ -0,0 +1,197 @@
+# ##### BEGIN MIT LICENSE BLOCK #####
+#
+# Copyright (c) 2015 - 2017 Pixar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#
+# ##### END MIT LICENSE BLOCK #####
+
+# Recording and replaying of Ri calls, so that archives can be written by
+# separate worker processes.  Blender data is only safe to read from the main
+# thread, and the prman Ri context is global to a process, so the exporter
+# records the calls for an archive into plain lists on the main thread and
+# hands them to a pool of python processes that each have their own prman.
+#
+# This module must not import bpy or anything from the addon, it is also run
+# as a script by the worker processes.
+
+import os
+import sys
+import pickle
+import queue
+import subprocess
+import threading
+import traceback
+
+
+# stands in for the value an Ri call returns, like the handle from
+# ri.ObjectBegin(), until the call is replayed for real
+class RibHandle:
+
+    def __init__(self, handle_id):
+        self.handle_id = handle_id
+
+
+# looks like an ri object to the export functions, but only records the calls
+# as (name, args, kwargs, handle_id, handle_args) tuples of plain python data
+class RibRecorder:
+
+    def __init__(self, ri):
+        self._ri = ri
+        self.calls = []
+
+    def __getattr__(self, name):
+        value = getattr(self._ri, name)
+        # constants like ri.P are taken from the real ri
+        if not callable(value):
+            return value
+
+        def record(*args, **kwargs):
+            handle = RibHandle(len(self.calls))
+            handle_args = dict((i, arg.handle_id) for i, arg in enumerate(args)
+                               if isinstance(arg, RibHandle))
+            if handle_args:
+                args = tuple(None if i in handle_args else arg
+                             for i, arg in enumerate(args))
+            self.calls.append((name, args, kwargs, handle.handle_id,
+                               handle_args))
+            return handle
+
+        return record
+
+
+def replay_calls(ri, calls):
+    handles = {}
+    for name, args, kwargs, handle_id, handle_args in calls:
+        if handle_args:
+            args = tuple(handles[handle_args[i]] if i in handle_args else arg
+                         for i, arg in enumerate(args))
+        handles[handle_id] = getattr(ri, name)(*args, **kwargs)
+
+
+def write_archive(ri, archive_filename, rib_options, calls):
+    if rib_options:
+        ri.Option("rib", rib_options)
+    ri.Begin(archive_filename)
+    try:
+        replay_calls(ri, calls)
+    finally:
+        ri.End()
+
+
+# a fixed number of worker processes fed from one job queue.
+# each job is (archive_filename, rib_options, calls).  join() returns
+# (archive_filename, error, job) for every job, where job is only set if no
+# worker could take it and it still has to be written by the caller.
+class RibWriterPool:
+
+    def __init__(self, num_workers, python_exe, env):
+        self.jobs = queue.Queue(maxsize=2 * num_workers)
+        self.results = []
+        self.lock = threading.Lock()
+        self.processes = []
+        self.threads = []
+
+        for i in range(num_workers):
+            process = subprocess.Popen([python_exe, os.path.abspath(__file__)],
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE, env=env)
+            self.processes.append(process)
+            thread = threading.Thread(target=self.feed_worker,
+                                      args=(process,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def add_result(self, result):
+        with self.lock:
+            self.results.append(result)
+
+    def feed_worker(self, process):
+        dead = False
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            if dead:
+                self.add_result((job[0], None, job))
+                continue
+            try:
+                data = pickle.dumps(job, pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                # something in the calls can't go to another process
+                self.add_result((job[0], None, job))
+                continue
+            try:
+                process.stdin.write(data)
+                process.stdin.flush()
+                archive_filename, error = pickle.load(process.stdout)
+                self.add_result((archive_filename, error, None))
+            except (EOFError, OSError, pickle.UnpicklingError):
+                # the worker died, hand its jobs back
+                dead = True
+                self.add_result((job[0], None, job))
+
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        process.wait()
+
+    def submit(self, archive_filename, rib_options, calls):
+        self.jobs.put((archive_filename, rib_options, calls))
+
+    def join(self):
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        return self.results
+
+
+def run_worker():
+    # keep the result stream apart from anything prman prints
+    results_out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    jobs_in = sys.stdin.buffer
+
+    import prman
+    prman.Init()
+    ri = prman.Ri()
+
+    while True:
+        try:
+            archive_filename, rib_options, calls = pickle.load(jobs_in)
+        except EOFError:
+            break
+        error = None
+        try:
+            write_archive(ri, archive_filename, rib_options, calls)
+        except Exception:
+            error = traceback.format_exc()
+        pickle.dump((archive_filename, error), results_out,
+                    pickle.HIGHEST_PROTOCOL)
+        results_out.flush()
+
+    prman.Cleanup()
+
+
+if __name__ == '__main__':
+    run_worker()
@@ -232,6 +232,8 @@ def update_conditional_visops(node):
 def update_func_with_inputs(self, context):
     # check if this prop is set on an input
     node = self.node if hasattr(self, 'node') else self
+    from .nodes import invalidate_textures
+    invalidate_textures(node.id_data)
 
     if node.renderman_node_type == 'lightfilter' and context and hasattr(context, 'lamp'):
         context.lamp.renderman.update_filter_shape()
@@ -269,6 +271,8 @@ def update_func_with_inputs(self, context):
 def update_func(self, context):
     # check if this prop is set on an input
     node = self.node if hasattr(self, 'node') else self
+    from .nodes import invalidate_textures
+    invalidate_textures(node.id_data)
 
     if node.renderman_node_type == 'lightfilter' and context and hasattr(context, 'lamp'):
         context.lamp.renderman.update_filter_shape()
@@ -609,6 +613,12 @@ def generate_property(sp):
     return (param_name, prop_meta, prop)
 
 
+# txmake options only change the converted texture
+def update_txmake_option(self, context):
+    from .nodes import invalidate_textures
+    invalidate_textures(self.id_data)
+
+
 def generate_txmake_options(parent_name):
     optionsMeta = {}
     optionsProps = {}
@@ -626,14 +636,16 @@ def generate_txmake_options(parent_name):
                                                  'widget': 'mapper',
                                                  '__noconnection': True}
             optionsProps[optionObject["name"]] = bpy.props.BoolProperty(name=optionObject[
-                                                                        'dispName'], default=optionObject['default'], description=optionObject['help'])
+                                                                        'dispName'], default=optionObject['default'], description=optionObject['help'],
+                                                                        update=update_txmake_option)
         elif optionObject['type'] == "enum":
             optionsProps[optionObject["name"]] = EnumProperty(name=optionObject["dispName"],
                                                               default=optionObject[
                                                                   "default"],
                                                               description=optionObject[
                                                                   "help"],
-                                                              items=optionObject["items"])
+                                                              items=optionObject["items"],
+                                                              update=update_txmake_option)
             optionsMeta[optionObject["name"]] = {'renderman_name': 'ishouldnotexport',
                                                  'name': optionObject["name"],
                                                  'renderman_type': 'enum',
@@ -656,7 +668,8 @@ def generate_txmake_options(parent_name):
             optionsProps[optionObject["name"]] = FloatProperty(name=optionObject["dispName"],
                                                                default=optionObject[
                                                                    "default"],
-                                                               description=optionObject["help"])
+                                                               description=optionObject["help"],
+                                                               update=update_txmake_option)
     return txmake.index, optionsMeta, optionsProps
 
 # map types in args files to socket types
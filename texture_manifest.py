@@ -0,0 +1,154 @@
+# ##### BEGIN MIT LICENSE BLOCK #####
+#
+# Copyright (c) 2015 - 2017 Pixar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#
+# ##### END MIT LICENSE BLOCK #####
+
+
+# The manifest of converted textures kept in the texture output folder.  For
+# every .tex it records the source file, its size, mtime and content hash,
+# the txmake options and the txmake that made it, so a texture is converted
+# again when any of those change and not otherwise.
+
+import os
+import json
+import hashlib
+
+TEXTURE_MANIFEST_VERSION = 1
+TEXTURE_MANIFEST_NAME = 'texture_manifest.json'
+
+
+def texture_manifest_path(texture_dir):
+    return os.path.join(texture_dir, TEXTURE_MANIFEST_NAME)
+
+
+def load_texture_manifest(texture_dir):
+    try:
+        with open(texture_manifest_path(texture_dir)) as f:
+            manifest = json.load(f)
+        if manifest.get('version') == TEXTURE_MANIFEST_VERSION:
+            return manifest['textures']
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return {}
+
+
+def save_texture_manifest(texture_dir, manifest):
+    path = texture_manifest_path(texture_dir)
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump({'version': TEXTURE_MANIFEST_VERSION,
+                       'textures': manifest}, f, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
+        return True
+    except OSError:
+        return False
+
+
+def hash_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# txmake has no cheap version query, so the binary itself stands in for
+# its version.  an upgraded RenderMan is a different file
+def get_txmake_version(txmake):
+    try:
+        stat = os.stat(txmake)
+    except OSError:
+        return txmake
+    return '%s:%d:%d' % (os.path.realpath(txmake), stat.st_size,
+                         int(stat.st_mtime))
+
+
+# the entry the manifest should have for in_file, hashing the source only
+# if its size or mtime moved since the old entry was made
+def get_source_entry(in_file, old_entry=None):
+    stat = os.stat(in_file)
+    entry = {'source': in_file, 'size': stat.st_size,
+             'mtime': stat.st_mtime}
+    if old_entry and old_entry.get('source') == in_file and \
+            old_entry.get('size') == stat.st_size and \
+            old_entry.get('mtime') == stat.st_mtime:
+        entry['hash'] = old_entry.get('hash')
+    else:
+        entry['hash'] = hash_file(in_file)
+    return entry
+
+
+# returns (up_to_date, entry), entry is what to record once out_file_path
+# has been made
+def check_texture(manifest, in_file, out_file_path, options, txmake_version):
+    key = os.path.basename(out_file_path)
+    old_entry = manifest.get(key)
+    try:
+        entry = get_source_entry(in_file, old_entry)
+    except OSError:
+        # missing source, txmake will complain about it
+        return False, None
+    entry['options'] = list(options)
+    entry['txmake'] = txmake_version
+    up_to_date = old_entry is not None and os.path.isfile(out_file_path) and \
+        all(old_entry.get(k) == entry[k]
+            for k in ('source', 'hash', 'options', 'txmake'))
+    if up_to_date and old_entry.get('mtime') != entry['mtime']:
+        # touched but not changed
+        manifest[key] = entry
+    return up_to_date, entry
+
+
+def record_texture(manifest, out_file_path, entry):
+    if entry is None:
+        manifest.pop(os.path.basename(out_file_path), None)
+    else:
+        manifest[os.path.basename(out_file_path)] = entry
+
+
+# .tex files in texture_dir whose source is gone, and with remove_untracked
+# the ones the manifest doesn't know about.  entries whose .tex is gone are
+# dropped from the manifest
+def clean_texture_dir(texture_dir, remove_untracked=False):
+    manifest = load_texture_manifest(texture_dir)
+    removed = []
+    for name, entry in list(manifest.items()):
+        tex_path = os.path.join(texture_dir, name)
+        if not os.path.isfile(tex_path):
+            del manifest[name]
+        elif not os.path.exists(entry.get('source', '')):
+            os.remove(tex_path)
+            del manifest[name]
+            removed.append(tex_path)
+
+    if remove_untracked:
+        for name in os.listdir(texture_dir):
+            tex_path = os.path.join(texture_dir, name)
+            if name.endswith('.tex') and name not in manifest and \
+                    os.path.isfile(tex_path):
+                os.remove(tex_path)
+                removed.append(tex_path)
+
+    save_texture_manifest(texture_dir, manifest)
+    return removed
@@ -298,6 +298,12 @@ class RENDER_PT_renderman_spooling(PRManButtonsPanel, Panel):
         sub_row.enabled = rm.external_animation
         sub_row.prop(scene, "frame_start", text="Start")
         sub_row.prop(scene, "frame_end", text="End")
+        row = layout.row()
+        row.enabled = rm.external_animation and rm.generate_rib
+        row.prop(rm, "distributed_rib_gen")
+        sub_row = row.row()
+        sub_row.enabled = rm.distributed_rib_gen
+        sub_row.prop(rm, "rib_gen_processes", text="Processes")
         col = layout.column()
         col.enabled = rm.generate_alf
         col.prop(rm, 'external_denoise')
@@ -582,8 +588,17 @@ class RENDER_PT_renderman_advanced_settings(PRManButtonsPanel, Panel):
         row.prop(rm, "rib_compression", text="")
 
         layout.separator()
-        layout.prop(rm, "always_generate_textures")
+        row = layout.row()
+        row.prop(rm, "always_generate_textures")
+        row.prop(rm, "texture_conversion_processes", text="Processes")
+        layout.operator('rman.clean_textures')
         layout.prop(rm, "lazy_rib_gen")
+        layout.operator('rman.clean_material_archives')
+        row = layout.row()
+        row.prop(rm, "parallel_archive_export")
+        sub_row = row.row()
+        sub_row.enabled = rm.parallel_archive_export
+        sub_row.prop(rm, "archive_export_processes", text="Processes")
         layout.prop(rm, "threads")
 
 
@@ -1520,6 +1535,8 @@ class PARTICLE_PT_renderman_particle(ParticleButtonsPanel, Panel, _RManPanelHead
             elif rm.particle_type == 'GROUP':
                 col.prop_search(rm, "particle_instance_object", bpy.data,
                                 "groups", text="")
+            if rm.particle_type in ('OBJECT', 'sphere', 'disk'):
+                col.prop(rm, 'instance_mode')
 
             if rm.particle_type == 'OBJECT' and rm.use_object_material:
                 pass
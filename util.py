@@ -32,6 +32,7 @@ import sys
 import fnmatch
 import subprocess
 import tempfile
+import numpy
 from subprocess import Popen, PIPE
 from mathutils import Matrix, Vector
 EnableDebugging = False
@@ -411,6 +412,10 @@ def rib(v, type_hint=None):
         # BBM modified from if to elif
         return list(v)
 
+    # flat buffers filled with foreach_get
+    elif type(v) == numpy.ndarray:
+        return v.tolist()
+
     # matrix
     elif type(v) == mathutils.Matrix:
         return [v[0][0], v[1][0], v[2][0], v[3][0],
@@ -589,15 +594,6 @@ def get_installed_rendermans():
     return rendermans
 
 
-# return true if an archive is older than the timestamp
-def check_if_archive_dirty(update_time, archive_filename):
-    if update_time > 0 and os.path.exists(archive_filename) \
-            and os.path.getmtime(archive_filename) >= update_time:
-        return False
-    else:
-        return True
-
-
 def find_it_path():
     rmantree = guess_rmantree()
 